@@ -0,0 +1,79 @@
+import logging
+import time
+
+from googleapiclient.errors import HttpError
+
+import quota
+import sheet
+
+REFRESH_INTERVAL = 60  # seconds between checks for changes to the Access Card sheet
+
+drive = None  # Drive API service, set with init() - used to check when the sheet was modified
+
+revision = None  # modifiedTime of the Access Card sheet when it was last read
+last_checked = None  # time.monotonic() when the sheet was last checked for changes
+
+# results of lookups in the Access Card sheet since it was last read
+staff = dict()  # cruzid -> whether they are staff
+access = dict()  # (tool, cruzid) -> whether they have access to the tool
+
+
+def init(drive_service):
+    """Set the Drive API service used to check the Access Card sheet for changes. Without it,
+    the sheet is reread every REFRESH_INTERVAL seconds."""
+    global drive
+    drive = drive_service
+
+
+def get_revision():
+    # get the modifiedTime of the Access Card sheet, or None if it can't be checked
+    spreadsheet_id = getattr(sheet, "SPREADSHEET_ID", None)
+    if drive is None or spreadsheet_id is None:
+        return None
+    try:
+        return (
+            drive.files()
+            .get(fileId=spreadsheet_id, fields="modifiedTime")
+            .execute()
+            .get("modifiedTime")
+        )
+    except HttpError as e:
+        logging.warning(f"Could not check Access Card sheet for changes: {e}")
+        return None
+
+
+def refresh(force=False):
+    """Reread the Access Card sheet if it has been modified since it was last read, checking at
+    most every REFRESH_INTERVAL seconds. Returns True if the sheet was reread."""
+    global revision, last_checked
+    now = time.monotonic()
+    if not force and last_checked is not None and now - last_checked < REFRESH_INTERVAL:
+        return False
+    last_checked = now
+
+    new_revision = get_revision()
+    if not force and new_revision is not None and new_revision == revision:
+        return False
+
+    # the sheet module reads the sheet itself, so only its rate can be limited here
+    quota.acquire()
+    sheet.get_sheet_data(False)
+    revision = new_revision
+    staff.clear()
+    access.clear()
+    return True
+
+
+def is_staff(cruzid):
+    """Whether the user is staff. Only the first lookup of a user after the sheet is read goes
+    to the sheet module - later ones are a dict lookup."""
+    if cruzid not in staff:
+        staff[cruzid] = bool(sheet.is_staff(cruzid=cruzid))
+    return staff[cruzid]
+
+
+def has_access(tool, cruzid):
+    """Whether the user has access to the tool, cached like is_staff()."""
+    if (tool, cruzid) not in access:
+        access[(tool, cruzid)] = bool(sheet.get_access(tool, cruzid=cruzid))
+    return access[(tool, cruzid)]
@@ -0,0 +1,88 @@
+import bisect
+import datetime
+import heapq
+
+CALENDAR_DAYS = 60  # days of opening hours computed at a time
+
+
+class LabCalendar:
+    """The lab's opening hours: open_hour to close_hour on the given weekdays (0 is Monday),
+    except on holidays. The open intervals are computed ahead, so lookups are a binary search.
+    """
+
+    def __init__(self, open_hour, close_hour, days=range(5), holidays=()):
+        if not days or open_hour >= close_hour:
+            raise ValueError("the lab must be open at some time")
+        self.open_hour = open_hour
+        self.close_hour = close_hour
+        self.days = set(days)
+        self.holidays = set(holidays)  # datetime.date
+
+        self.opens = []  # start of each open interval, in order
+        self.closes = []  # end of each open interval
+        self.first_date = None  # first date that has been computed
+        self.next_date = None  # first date that has not been computed yet
+
+    def extend(self):
+        # compute open intervals from next_date for CALENDAR_DAYS days
+        for _ in range(CALENDAR_DAYS):
+            date = self.next_date
+            self.next_date += datetime.timedelta(days=1)
+            if date.weekday() not in self.days or date in self.holidays:
+                continue
+            midnight = datetime.datetime.combine(date, datetime.time())
+            self.opens.append(midnight + datetime.timedelta(hours=self.open_hour))
+            self.closes.append(midnight + datetime.timedelta(hours=self.close_hour))
+
+    def interval(self, time):
+        # index of the first open interval that ends after time
+        if self.first_date is None or time.date() < self.first_date:
+            # start computing from the day of the earliest time looked up
+            self.first_date = self.next_date = time.date()
+            self.opens.clear()
+            self.closes.clear()
+        i = bisect.bisect_right(self.closes, time)
+        while i == len(self.closes):
+            self.extend()
+            i = bisect.bisect_right(self.closes, time)
+        return i
+
+    def next_open(self, time):
+        """The first time the lab is open from time onward."""
+        return max(time, self.opens[self.interval(time)])
+
+    def is_open(self, time):
+        return self.next_open(time) == time
+
+    def add_open_time(self, time, duration):
+        """The time at which the lab has been open for duration (a timedelta) after time."""
+        i = self.interval(time)
+        time = max(time, self.opens[i])
+        while duration > self.closes[i] - time:
+            duration -= self.closes[i] - time
+            i += 1
+            if i == len(self.closes):
+                self.extend()
+            time = self.opens[i]
+        return time + duration
+
+
+def estimate_starts(free_times, users, calendar, usage):
+    """Estimate when each of the next users can start, if each takes the printer that is free
+    soonest when it is their turn and uses it for usage (a timedelta).
+
+    free_times: the predicted time each printer that can be booked is free
+    Returns: the estimated start time of each of the first users, or None if there are no
+    printers to book
+    """
+    if not free_times:
+        return [None] * users
+    free_times = list(free_times)
+    heapq.heapify(free_times)
+
+    starts = []
+    for _ in range(users):
+        start = calendar.next_open(heapq.heappop(free_times))
+        starts.append(start)
+        heapq.heappush(free_times, start + usage)
+    return starts
@@ -0,0 +1,125 @@
+"""Benchmark the scheduler in callback.py against the offline fakes in sim.py.
+
+Reports per-tick latency, Sheets API requests per tick, memory and how much printing happened
+for each number of printers.
+Every run is in a fresh process, since callback keeps its state in module globals.
+
+    python bench.py                          # 10, 100 and 1,000 printers with 10k bookings
+    python bench.py --printers 100 --ticks 600
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+PRINTER_COUNTS = [10, 100, 1000]
+BOOKINGS = 10000
+TICKS = 300  # simulated seconds
+
+
+def run(printers, bookings, ticks, trace_memory):
+    from sim import Simulation
+
+    if trace_memory:
+        tracemalloc.start()
+
+    started = time.perf_counter()
+    sim = Simulation(printers=printers, bookings=bookings, duration=ticks)
+    startup = time.perf_counter() - started
+
+    latencies = []
+    calls = []
+    printing = 0  # printer-seconds spent printing
+    finished = 0  # prints that finished
+    states = [printer.gcode_state for _, printer in sim.callback.printers]
+    for _ in range(ticks):
+        started = time.perf_counter()
+        calls.append(sim.tick())
+        latencies.append(time.perf_counter() - started)
+
+        for i, (_, printer) in enumerate(sim.callback.printers):
+            printing += printer.gcode_state == "RUNNING"
+            finished += states[i] == "RUNNING" and printer.gcode_state == "FINISH"
+            states[i] = printer.gcode_state
+
+    latencies.sort()
+    result = {
+        "printers": printers,
+        "bookings": bookings,
+        "ticks": ticks,
+        "startup_s": startup,
+        "mean_ms": statistics.mean(latencies) * 1000,
+        "p50_ms": latencies[len(latencies) // 2] * 1000,
+        "p95_ms": latencies[int(len(latencies) * 0.95)] * 1000,
+        "max_ms": latencies[-1] * 1000,
+        "calls_per_tick": sum(calls) / ticks,
+        "emails": len(sim.gmail.messages),
+        "printing": printing / (printers * ticks),
+        "prints_finished": finished,
+        "jobs": sim.scheduler.stats(),
+    }
+    if trace_memory:
+        result["memory_mb"] = tracemalloc.get_traced_memory()[1] / 2**20
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--printers", type=int, nargs="+", default=PRINTER_COUNTS)
+    parser.add_argument("--bookings", type=int, default=BOOKINGS)
+    parser.add_argument("--ticks", type=int, default=TICKS)
+    parser.add_argument(
+        "--no-memory",
+        action="store_true",
+        help="do not trace memory, which slows down every tick",
+    )
+    parser.add_argument("--json", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.json:
+        # a single run, in the process started for it below
+        result = run(args.printers[0], args.bookings, args.ticks, not args.no_memory)
+        print(json.dumps(result))
+        return
+
+    print(
+        f"{'printers':>8} {'bookings':>8} {'startup s':>9} {'mean ms':>8} {'p50 ms':>8} "
+        f"{'p95 ms':>8} {'max ms':>8} {'calls/tick':>10} {'peak MB':>8} {'printing':>8} "
+        f"{'finished':>8}"
+    )
+    for printers in args.printers:
+        command = [
+            sys.executable,
+            __file__,
+            "--json",
+            "--printers",
+            str(printers),
+            "--bookings",
+            str(args.bookings),
+            "--ticks",
+            str(args.ticks),
+        ]
+        if args.no_memory:
+            command.append("--no-memory")
+        output = subprocess.run(command, capture_output=True, text=True, check=True)
+        r = json.loads(output.stdout.strip().splitlines()[-1])
+        if not r["printing"]:
+            # the printing, start form and prebooking paths were not measured
+            print(
+                f"warning: no printer printed in {r['ticks']} ticks with {printers} printers",
+                file=sys.stderr,
+            )
+        print(
+            f"{r['printers']:>8} {r['bookings']:>8} {r['startup_s']:>9.2f} {r['mean_ms']:>8.2f} "
+            f"{r['p50_ms']:>8.2f} {r['p95_ms']:>8.2f} {r['max_ms']:>8.2f} "
+            f"{r['calls_per_tick']:>10.2f} {r.get('memory_mb', float('nan')):>8.1f} "
+            f"{r['printing']:>8.0%} {r['prints_finished']:>8}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+from collections import deque
+
+
+class BookingQueue:
+    """Users waiting for a printer, in the order they booked, with the row of their booking in
+    the Booking sheet. Adding (at either end), taking the next user, removing and checking for a
+    user are O(1).
+
+    Removed users are left in the deque and skipped when they reach the front, so each entry
+    carries a sequence number to tell it apart from a later booking by the same user.
+    """
+
+    def __init__(self):
+        self.order = deque()  # (cruzid, seq), oldest first - may include removed users
+        self.users = dict()  # cruzid -> (row, seq) for users still waiting
+        self.seq = 0
+
+    def __len__(self):
+        return len(self.users)
+
+    def __contains__(self, cruzid):
+        return cruzid in self.users
+
+    def __iter__(self):
+        # users still waiting, in order
+        for cruzid, seq in self.order:
+            if self.users.get(cruzid, (None, None))[1] == seq:
+                yield cruzid
+
+    def enqueue(self, cruzid, row):
+        """Add a user to the back of the queue. Does nothing if they are already waiting."""
+        if cruzid in self.users:
+            return
+        self.seq += 1
+        self.users[cruzid] = (row, self.seq)
+        self.order.append((cruzid, self.seq))
+
+    def requeue_front(self, cruzid, row):
+        """Put a user back at the front of the queue, e.g. when the printer they were taken off
+        the queue for went away. Does nothing if they are already waiting."""
+        if cruzid in self.users:
+            return
+        self.seq += 1
+        self.users[cruzid] = (row, self.seq)
+        self.order.appendleft((cruzid, self.seq))
+
+    def dequeue(self):
+        """Take the user at the front of the queue.
+        Returns: (cruzid, booking row)
+        Raises: IndexError if nobody is waiting
+        """
+        while self.order:
+            cruzid, seq = self.order.popleft()
+            if self.users.get(cruzid, (None, None))[1] == seq:
+                row, _ = self.users.pop(cruzid)
+                return cruzid, row
+        raise IndexError("dequeue from an empty BookingQueue")
+
+    def remove(self, cruzid):
+        """Remove a user from the queue wherever they are.
+        Returns: their booking row, or None if they were not waiting
+        """
+        if cruzid not in self.users:
+            return None
+        row, _ = self.users.pop(cruzid)
+
+        # drop removed entries once they outnumber the users still waiting
+        if len(self.order) > 2 * len(self.users) + 16:
+            self.order = deque(
+                (c, s) for c, s in self.order if self.users.get(c, (None, None))[1] == s
+            )
+        return row
+
+    def row(self, cruzid):
+        """Get the booking row of a waiting user."""
+        return self.users[cruzid][0]
+
+    def to_list(self):
+        return [[cruzid, self.row(cruzid)] for cruzid in self]
+
+    @classmethod
+    def from_list(cls, users):
+        queue = cls()
+        for cruzid, row in users:
+            queue.enqueue(cruzid, row)
+        return queue
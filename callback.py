@@ -1,24 +1,40 @@
+import bisect
 import datetime
 import json
 import logging
 import os
+import queue
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import pandas as pd
 from bpm.bambuconfig import BambuConfig
 from bpm.bambuprinter import BambuPrinter
 from bpm.bambutools import PrinterState, parseFan, parseStage
+from google.auth.exceptions import RefreshError
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 
-import sheet
-from gmail import gmail_send_message
-
-# If modifying these scopes, delete the file token.json.
-SCOPES = ["https://www.googleapis.com/auth/spreadsheets"]
+import access
+import assignment
+import logconfig
+import metrics
+import quota
+from booking_queue import BookingQueue
+from scheduler import Scheduler
+from state_store import StateStore
+from telemetry import Telemetry
+from gmail import gmail_queue_message, start_outbox, stop_outbox
+
+SHEETS_SCOPE = "https://www.googleapis.com/auth/spreadsheets"
+# to check when the Access Card sheet was last modified
+DRIVE_SCOPE = "https://www.googleapis.com/auth/drive.metadata.readonly"
+# If modifying these scopes, delete the file token.json. Until then, the token keeps the scopes
+# it was granted, and the Access Card sheet is reread on an interval without the Drive scope.
+SCOPES = [SHEETS_SCOPE, DRIVE_SCOPE]
 
 SPREADSHEET_ID = "1vk4Im7TahIPYzG3kIxSKjpDKbko_QkMyfFuhzYoSLjc"
 BOOKING_SHEET = "Booking"
@@ -26,13 +42,31 @@ STARTING_SHEET = "Starting"
 STATUS_SHEET = "Printer Status"
 LIMITS_SHEET = "Filament Limits"
 LIMITS_RESET_DATE_SHEET = "Filament Limits Reset Date"
+SHEET_RANGES = [
+    BOOKING_SHEET,
+    STARTING_SHEET,
+    STATUS_SHEET,
+    LIMITS_SHEET,
+]
 
 booking_data = None
 starting_data = None
-status_data = None
-limits_data = None
+starting_times = (
+    []
+)  # parsed Timestamp of each row of starting_data, in submission order
+status_data = None  # only the header is used once printer_status is loaded
+limits_data = None  # serialized from limits when they change
 limit_reset_date = None
 
+# remaining grams for each CruzID - the source of truth for the Filament Limits sheet once read
+limits = None
+limits_changed = (
+    False  # whether limits changed since the Filament Limits sheet was written
+)
+
+# rows of each sheet as of the last read or write, used to only write changed rows
+sheet_snapshots = dict()
+
 booking_statuses = [
     "Waiting for Printer",
     "Booked Printer",
@@ -59,11 +93,47 @@ PRINTER_AVAILABLE = 2
 PRINTER_OFFLINE = 3
 PRINTER_CANCEL_PENDING = 4
 
+STATUS_TIME_FORMAT = "%Y-%m-%d %H:%M"
+STARTING_TIME_FORMAT = "%m/%d/%Y %H:%M:%S"  # Timestamp column of the start form
+
+printer_status = []  # PrinterStatus for each printer num, in status sheet order
+printer_numbers = dict()  # printer name -> printer num
+# printer num -> (gcode state, stage, file) when the printer was last logged
+logged_printer_states = dict()
+
 booking_index = 0
 
-BOOKING_TIME = 4  # hours
+BOOKING_TIME = 4  # hours of lab opening hours a user has to start their print
+LAB_OPEN_HOUR = 12  # the lab is open from 12pm
+LAB_CLOSE_HOUR = 21  # to 9pm
+LAB_DAYS = range(5)  # Monday to Friday
+LAB_HOLIDAYS = []  # dates the lab is closed, as "YYYY-MM-DD"
+EXPECTED_USAGE = (
+    2  # hours a booked user is expected to use a printer for, to estimate waits
+)
+ESTIMATE_RESOLUTION = 15  # minutes estimated start times are rounded up to
+PREBOOK_WINDOW = (
+    15  # minutes before a print ends that the next user is told the printer is theirs
+)
+ESTIMATED_START_COLUMN = (
+    "Estimated Start"  # optional Booking sheet column for estimated starts
+)
 MAX_TOOL_TEMP = 220  # degrees Celsius
 TIME_TO_START = 10  # minutes
+DEFAULT_LIMIT = 1000  # grams of filament per user per quarter
+PRINTER_INTERVAL = 1  # seconds between checks of every printer
+SYNC_INTERVAL = 10  # seconds between syncs with the sheets
+LIMITS_RESET_INTERVAL = (
+    3600  # seconds between checks of the limits reset date and merges of limit edits
+)
+STARTUP_TIMEOUT = 30  # seconds to wait for printers to connect at startup
+STATE_FILE = "state.db"  # scheduler state, checkpointed so it survives a restart
+TELEMETRY_PATH = "telemetry"  # memory-mapped telemetry history of every printer
+TELEMETRY_SNAPSHOT_INTERVAL = 60  # seconds between writes of the telemetry to disk
+LOG_JSON_LINES = (
+    False  # whether to also log to logs/log.jsonl, one JSON object per record
+)
+METRICS_PORT = 9101  # metrics are served on http://localhost:METRICS_PORT/metrics
 
 EMAIL_SENDER = "imadan1@ucsc.edu"
 EMAIL_CC = ""
@@ -71,281 +141,499 @@ EMAIL_REPLY_TO = ""
 # EMAIL_CC = "jbarbera@ucsc.edu"
 # EMAIL_REPLY_TO = "jbarbera@ucsc.edu"
 
-# Set the working directory to the directory of this file
+# create new logger with all levels - handlers are added by setup_logging()
 path = os.path.dirname(os.path.abspath(__file__))
-os.chdir(path)
 
-# Create a new directory for logs if it doesn't exist
-if not os.path.exists(path + "/logs"):
-    os.makedirs(path + "/logs")
-
-# create new logger with all levels
 logger = logging.getLogger("root")
-logger.setLevel(logging.DEBUG) 
-
-# create file handler which logs debug messages (and above - everything)
-fh_debug = logging.FileHandler(f"logs/{str(datetime.datetime.now())}-debug.log")
-fh_debug.setLevel(logging.DEBUG)
-
-# create file handler which logs only info messages (and above)
-fh_info = logging.FileHandler(f"logs/{str(datetime.datetime.now())}-info.log")
-fh_info.setLevel(logging.DEBUG)
-
-# create console handler which only logs warnings (and above)
-ch = logging.StreamHandler()
-ch.setLevel(logging.WARNING)
-
-# create formatter and add it to the handlers
-formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s: %(message)s")
-fh_debug.setFormatter(formatter)
-fh_info.setFormatter(formatter)
-ch.setFormatter(formatter)
-
-# add the handlers to the logger
-logger.addHandler(fh_debug)
-logger.addHandler(fh_info)
-logger.addHandler(ch)
+logger.setLevel(logging.DEBUG)
 
-try:
-    printer_data = json.load(open("printers.json"))
-except FileNotFoundError:
-    logger.error("No printers.json file found.")
-    exit(1)
+printer_data = (
+    dict()
+)  # printer name -> config from printers.json, set by load_printer_data()
 
 printers = []
 
-creds = None
-# The file token.json stores the user's access and refresh tokens, and is
-# created automatically when the authorization flow completes for the first
-# time.
-if os.path.exists("token.json"):
-    creds = Credentials.from_authorized_user_file("token.json", SCOPES)
-elif not os.path.exists("credentials.json"):
-    logger.error("No credentials.json file found.")
-    exit(1)
-# If there are no (valid) credentials available, let the user log in (assuming credentials.json exists).
-if not creds or not creds.valid:
-    if creds and creds.expired and creds.refresh_token:
-        creds.refresh(Request())
-    else:
-        flow = InstalledAppFlow.from_client_secrets_file("credentials.json", SCOPES)
-        creds = flow.run_local_server(port=44649)
-    # Save the credentials for the next run
-    with open("token.json", "w") as token:
-        token.write(creds.to_json())
-
-try:
-    service = build("sheets", "v4", credentials=creds)
-
-    # Call the Sheets API
-    g_sheets = service.spreadsheets()
-
-except HttpError as e:
-    logger.error(e)
-    exit(1)
-
-
-def get_sheet_data():
-    global booking_data, starting_data, status_data, limits_data
+state_store = None  # StateStore, opened by main
+telemetry = None  # Telemetry of every printer, opened once the printers are connected
+
+# users who are waiting for printer, with the row numbers (in booking_data) of their bookings
+waiting_for_printer = BookingQueue()
+
+# users who are currently booked or printing -> row numbers (in booking_data) of their bookings
+currently_booked_or_printing = dict()
+
+# printers that have started prints without a booking -> printer num, start time
+print_without_booking = dict()
+
+# printers that have started prints with a booking -> printer num, user (from printer_status), row number in booking_data, start time
+print_with_booking = dict()
+
+printer_over_limit = (
+    []
+)  # printers that have started prints with a booking but are over their weight limit
+
+complete_prints = []  # users who have completed their prints since the last sync
+
+# printer num -> user who has been told the printer is theirs once its current print ends
+prebooked = dict()
+
+lab_calendar = assignment.LabCalendar(
+    LAB_OPEN_HOUR,
+    LAB_CLOSE_HOUR,
+    LAB_DAYS,
+    [datetime.date.fromisoformat(d) for d in LAB_HOLIDAYS],
+)
+
+# (printer num, gcode state, target tool temp) for printers whose state has changed
+printer_events = queue.Queue()
+# last (gcode state, target tool temp) seen for each printer num
+printer_event_states = dict()
+
+
+def collect_printer_status():
+    # 1 for the current status of each printer, read when the metrics are scraped
+    return {
+        (s.name, printer_statuses[s.status] if s.status is not None else ""): 1
+        for s in printer_status
+    }
+
+
+def collect_printer_temperatures(attribute):
+    return lambda: {(name,): getattr(printer, attribute) for name, printer in printers}
+
+
+phase_seconds = metrics.Histogram(
+    "scheduler_phase_seconds", "Time taken by each phase of the scheduler", ["phase"]
+)
+cancellations = metrics.Counter(
+    "print_cancellations_total", "Prints canceled, by reason", ["reason"]
+)
+metrics.Gauge(
+    "waiting_users",
+    "Users waiting for a printer",
+    collect=lambda: {(): len(waiting_for_printer)},
+)
+metrics.Gauge(
+    "booked_or_printing_users",
+    "Users who are booked on or printing on a printer",
+    collect=lambda: {(): len(currently_booked_or_printing)},
+)
+metrics.Gauge(
+    "printer_status",
+    "1 for the current status of each printer",
+    ["printer", "status"],
+    collect=collect_printer_status,
+)
+metrics.Gauge(
+    "printer_tool_temperature_celsius",
+    "Tool temperature of each printer",
+    ["printer"],
+    collect=collect_printer_temperatures("tool_temp"),
+)
+metrics.Gauge(
+    "printer_bed_temperature_celsius",
+    "Bed temperature of each printer",
+    ["printer"],
+    collect=collect_printer_temperatures("bed_temp"),
+)
+
+g_sheets = None  # Sheets API spreadsheets() resource, set by connect()
+
+
+def now():
+    # current time - every scheduling decision goes through this, so a simulation can replace it
+    return datetime.datetime.now()
+
+
+def setup_logging():
+    """Log everything to a debug log file, info and above to an info log file, and warnings
+    and above to the console, from a background thread. Returns the QueueListener that writes
+    the logs."""
+    return logconfig.setup(logger, path + "/logs", LOG_JSON_LINES)
+
+
+def load_printer_data():
+    global printer_data
     try:
-        booking = (
-            g_sheets.values()
-            .get(spreadsheetId=SPREADSHEET_ID, range=BOOKING_SHEET)
-            .execute()
-        )
+        printer_data = json.load(open("printers.json"))
+    except FileNotFoundError:
+        logger.error("No printers.json file found.")
+        exit(1)
 
-        values = booking.get("values", [])
 
-        if not values:
-            logger.error("No booking data found.")
-            exit(1)
+def connect():
+    """Authorize with Google and create the Sheets and Drive API clients."""
+    global g_sheets
+    creds = None
+    # The file token.json stores the user's access and refresh tokens, and is
+    # created automatically when the authorization flow completes for the first
+    # time.
+    if os.path.exists("token.json"):
+        # refresh with the scopes the token was granted, since asking for more fails
+        creds = Credentials.from_authorized_user_file("token.json")
+    elif not os.path.exists("credentials.json"):
+        logger.error("No credentials.json file found.")
+        exit(1)
+    # If there are no (valid) credentials available, let the user log in (assuming credentials.json exists).
+    if not creds or not creds.valid:
+        if creds and creds.expired and creds.refresh_token:
+            try:
+                creds.refresh(Request())
+            except RefreshError as e:
+                # e.g. invalid_scope for a token saved without its scopes - the Sheets scope is
+                # the one every token was granted
+                logger.error(f"Could not refresh token: {e}, retrying with Sheets only")
+                creds = Credentials.from_authorized_user_file(
+                    "token.json", [SHEETS_SCOPE]
+                )
+                creds.refresh(Request())
+        else:
+            flow = InstalledAppFlow.from_client_secrets_file("credentials.json", SCOPES)
+            creds = flow.run_local_server(port=44649)
+        # Save the credentials for the next run
+        with open("token.json", "w") as token:
+            token.write(creds.to_json())
 
-        values = [r + [""] * (len(values[0]) - len(r)) for r in values]
+    try:
+        service = build("sheets", "v4", credentials=creds)
 
-        booking_data = pd.DataFrame(
-            values[1:] if len(values) > 1 else None,
-            columns=values[0],
-        )
+        # Call the Sheets API
+        g_sheets = service.spreadsheets()
 
-        starting = (
-            g_sheets.values()
-            .get(spreadsheetId=SPREADSHEET_ID, range=STARTING_SHEET)
-            .execute()
-        )
+        # only reread the Access Card sheet when it has been modified
+        if creds.has_scopes([DRIVE_SCOPE]):
+            access.init(build("drive", "v3", credentials=creds))
+        else:
+            logger.warning(
+                "token.json was not granted the Drive scope, so the Access Card sheet is reread "
+                "on an interval - delete token.json and restart to authorize it"
+            )
 
-        values = starting.get("values", [])
+    except HttpError as e:
+        logger.error(e)
+        exit(1)
 
-        if not values:
-            logger.error("No starting data found.")
-            exit(1)
 
-        values = [r + [""] * (len(values[0]) - len(r)) for r in values]
+def values_to_frame(values):
+    # pad rows to the width of the header row, since the API trims trailing empty cells
+    values = [r + [""] * (len(values[0]) - len(r)) for r in values]
 
-        starting_data = pd.DataFrame(
-            values[1:] if len(values) > 1 else None,
-            columns=values[0],
-        )
+    return pd.DataFrame(
+        values[1:] if len(values) > 1 else None,
+        columns=values[0],
+    )
 
-        status = (
-            g_sheets.values()
-            .get(spreadsheetId=SPREADSHEET_ID, range=STATUS_SHEET)
-            .execute()
-        )
 
-        values = status.get("values", [])
+def column_letter(number):
+    # convert a 1-based column number to its A1 notation letters (1 -> A, 27 -> AA)
+    letters = ""
+    while number > 0:
+        number, remainder = divmod(number - 1, 26)
+        letters = chr(ord("A") + remainder) + letters
+    return letters
 
-        if not values:
-            logger.error("No status data found.")
-            exit(1)
 
-        values = [r + [""] * (len(values[0]) - len(r)) for r in values]
+def update_booking_data(header, values):
+    """Replace the cached Booking rows from booking_index onward with values, which
+    were read starting at that row. Returns False if the header row changed since the
+    whole sheet was last read, in which case the cache is dropped so it gets reread."""
+    global booking_data
+    if not header or header[0] != booking_data.columns.tolist():
+        logger.warning("Booking sheet header changed, rereading the whole sheet.")
+        booking_data = None
+        return False
 
-        status_data = pd.DataFrame(
-            values[1:] if len(values) > 1 else None,
-            columns=values[0],
-        )
+    columns = header[0]
+    values = [r + [""] * (len(columns) - len(r)) for r in values]
 
-        limits = (
-            g_sheets.values()
-            .get(spreadsheetId=SPREADSHEET_ID, range=LIMITS_SHEET)
-            .execute()
+    if values:
+        # keep the row numbers of the cached frame, so rows can still be looked up by index
+        tail = pd.DataFrame(
+            values,
+            columns=columns,
+            index=range(booking_index, booking_index + len(values)),
         )
+        booking_data = pd.concat([booking_data.iloc[:booking_index], tail])
+    else:
+        booking_data = booking_data.iloc[:booking_index].copy()
 
-        values = limits.get("values", [])
-
-        if not values:
-            logger.error("No limits data found.")
-            exit(1)
+    sheet_snapshots[BOOKING_SHEET] = sheet_snapshots[BOOKING_SHEET][
+        : booking_index + 1
+    ] + [[str(v) for v in r] for r in values]
+    return True
 
-        values = [r + [""] * (len(values[0]) - len(r)) for r in values]
 
-        limits_data = pd.DataFrame(
-            values[1:] if len(values) > 1 else None,
-            columns=values[0],
+def parse_limit(cruzid, grams):
+    # a limit cell that is not a whole number falls back to the default limit
+    try:
+        return int(grams)
+    except (TypeError, ValueError):
+        logger.warning(
+            f"Invalid filament limit for {cruzid}: {grams!r}, using {DEFAULT_LIMIT}"
         )
+        return DEFAULT_LIMIT
+
+
+def load_limits(frame):
+    # load the limits ledger from the Filament Limits sheet
+    global limits, limits_changed
+    limits = {
+        cruzid: parse_limit(cruzid, grams)
+        for cruzid, grams in zip(frame["CruzID"], frame["Limit (grams)"])
+        if cruzid
+    }
+    limits_changed = False
+
+
+def merge_limits(rows, old_rows):
+    """Merge staff edits to the Filament Limits sheet into the ledger. rows are the sheet's rows
+    as read now, and old_rows as they were last read or written, so the rows that differ were
+    edited on the sheet - their limits replace the ledger's, and deleted rows are dropped.
+    """
+    global limits
+    old = {row[0]: row[1:] for row in old_rows[1:] if row and row[0]}
+    new = {row[0]: row[1:] for row in rows[1:] if row and row[0]}
+    for cruzid, cells in new.items():
+        if old.get(cruzid) != cells:
+            logger.info(f"Filament limit for {cruzid} changed on the sheet")
+            limits[cruzid] = parse_limit(cruzid, cells[0] if cells else "")
+    for cruzid in old.keys() - new.keys():
+        limits.pop(cruzid, None)
+
+    # keep the order of the sheet, so writing the ledger back only changes the rows that changed
+    limits = {cruzid: limits[cruzid] for cruzid in new if cruzid in limits} | {
+        cruzid: grams for cruzid, grams in limits.items() if cruzid not in new
+    }
+
+
+def get_sheet_data(ranges=None):
+    """Read the automation sheets in a single batchGet round-trip.
+    Every sheet except the limits reset date is read if ranges is not given. Returns True if every requested
+    range was read, False otherwise - ranges that could not be read keep their
+    previous data and are logged individually.
+
+    Once the Booking sheet has been read, only its header and the rows from
+    booking_index onward are read again, since rows before that are no longer active.
+    The Filament Limits and Printer Status sheets are only read until they have been loaded.
+    Reading the Filament Limits sheet again (by passing it in ranges) merges staff edits into
+    the ledger.
+    """
+    global booking_data, starting_data, status_data, limits_data, limit_reset_date
+    if ranges is None:
+        ranges = [
+            name
+            for name in SHEET_RANGES
+            if not (name == LIMITS_SHEET and limits is not None)
+            and not (name == STATUS_SHEET and printer_status)
+        ]
 
-    except HttpError as e:
-        logger.error(e)
-        exit(1)
+    incremental_booking = BOOKING_SHEET in ranges and booking_data is not None
 
+    request_ranges = [
+        name for name in ranges if not (incremental_booking and name == BOOKING_SHEET)
+    ]
+    if incremental_booking:
+        last_column = column_letter(len(booking_data.columns))
+        request_ranges += [
+            f"'{BOOKING_SHEET}'!1:1",
+            f"'{BOOKING_SHEET}'!A{booking_index + 2}:{last_column}",
+        ]
 
-def write_booking_sheet():
     try:
-        vals = booking_data.values.tolist()
-        vals.insert(0, booking_data.columns.tolist())
-        _ = (
-            g_sheets.values()
-            .update(
-                spreadsheetId=SPREADSHEET_ID,
-                range=BOOKING_SHEET,
-                valueInputOption="USER_ENTERED",
-                body={"values": vals},
+        result = quota.execute(
+            g_sheets.values().batchGet(
+                spreadsheetId=SPREADSHEET_ID, ranges=request_ranges
             )
-            .execute()
         )
-        return True
     except HttpError as e:
-        logger.error(e)
+        logger.error(f"Could not read {', '.join(ranges)}: {e}")
         return False
 
+    value_ranges = [v.get("values", []) for v in result.get("valueRanges", [])]
+    value_ranges += [[]] * (len(request_ranges) - len(value_ranges))
+    success = True
+
+    if incremental_booking:
+        booking_tail = value_ranges.pop()
+        booking_header = value_ranges.pop()
+        success = update_booking_data(booking_header, booking_tail)
+
+    for name, values in zip(request_ranges, value_ranges):
+        if name == LIMITS_RESET_DATE_SHEET:
+            # a blank reset date just means no reset is scheduled
+            if not values:
+                logger.error("No reset date found.")
+                limit_reset_date = None
+            else:
+                limit_reset_date = datetime.datetime.strptime(
+                    values[0][0] + " 00:00:00", "%m/%d/%Y %H:%M:%S"
+                )
+            continue
 
-def write_starting_sheet():
+        if not values:
+            logger.error(f"No data found in {name} sheet.")
+            success = False
+            continue
+
+        frame = values_to_frame(values)
+        old_rows = sheet_snapshots.get(name, [])
+        # snapshot what was read, so only rows changed after this are written back
+        sheet_snapshots[name] = frame_rows(frame)
+
+        if name == BOOKING_SHEET:
+            booking_data = frame
+        elif name == STARTING_SHEET:
+            starting_data = frame
+            update_starting_times()
+        elif name == STATUS_SHEET:
+            status_data = frame
+            load_printer_status(frame)
+        elif name == LIMITS_SHEET:
+            limits_data = frame
+            if limits is None:
+                load_limits(frame)
+            else:
+                merge_limits(sheet_snapshots[name], old_rows)
+
+    return success
+
+
+def update_starting_times():
+    """Parse the timestamps of the Starting sheet rows that were not parsed before. The start
+    form only appends rows, so unless the rows that were parsed changed, only new submissions
+    are parsed."""
+    global starting_times
+    timestamps = starting_data["Timestamp"]
+    parsed = len(starting_times)
+    if parsed > len(timestamps) or (
+        parsed and starting_times[-1] != parse_starting_time(timestamps.iat[parsed - 1])
+    ):
+        # rows were deleted or edited, so parse them all again
+        starting_times = []
+    for t in timestamps.iloc[len(starting_times) :]:
+        starting_times.append(parse_starting_time(t))
+        if starting_times[-1] == datetime.datetime.min:
+            logger.warning(f"Invalid timestamp in Starting sheet: {t!r}")
+
+
+def parse_starting_time(t):
+    # a timestamp that cannot be parsed is datetime.min, so the row is never treated as recent
     try:
-        vals = starting_data.values.tolist()
-        vals.insert(0, starting_data.columns.tolist())
-        _ = (
-            g_sheets.values()
-            .update(
-                spreadsheetId=SPREADSHEET_ID,
-                range=STARTING_SHEET,
-                valueInputOption="USER_ENTERED",
-                body={"values": vals},
-            )
-            .execute()
+        return datetime.datetime.strptime(t, STARTING_TIME_FORMAT)
+    except (TypeError, ValueError):
+        return datetime.datetime.min
+
+
+def frame_rows(frame):
+    # serialize a DataFrame (header row first) the way its cells read back from the sheet
+    rows = [frame.columns.tolist()] + frame.values.tolist()
+    return [["" if v is None else str(v) for v in r] for r in rows]
+
+
+def changed_ranges(name, rows):
+    """Compare rows against the last snapshot of a sheet and return the runs of
+    consecutive changed rows as ValueRanges. Rows that no longer exist are blanked."""
+    old = sheet_snapshots.get(name, [])
+    length = max(len(rows), len(old))
+    data = []
+
+    i = 0
+    while i < length:
+        if i < len(rows) and i < len(old) and rows[i] == old[i]:
+            i += 1
+            continue
+
+        # find the end of this run of changed rows
+        j = i
+        while j < length and not (j < len(rows) and j < len(old) and rows[j] == old[j]):
+            j += 1
+
+        data.append(
+            {
+                "range": f"'{name}'!A{i + 1}",
+                "values": [
+                    rows[k] if k < len(rows) else [""] * len(old[k])
+                    for k in range(i, j)
+                ],
+            }
         )
-        return True
-    except HttpError as e:
-        logger.error(e)
-        return False
+        i = j
 
+    return data
 
-def write_status_sheet():
-    try:
-        vals = status_data.values.tolist()
-        vals.insert(0, status_data.columns.tolist())
-        _ = (
-            g_sheets.values()
-            .update(
-                spreadsheetId=SPREADSHEET_ID,
-                range=STATUS_SHEET,
-                valueInputOption="USER_ENTERED",
-                body={"values": vals},
-            )
-            .execute()
-        )
-        return True
-    except HttpError as e:
-        logger.error(e)
-        return False
 
+def write_sheet_data(names=None):
+    """Write the rows of the automation sheets that changed since they were last
+    read or written, grouped into one batchUpdate request. Every sheet is
+    checked if names is not given. No request is made if nothing changed."""
+    global limits_data, limits_changed
+    if names is None:
+        names = [BOOKING_SHEET, STARTING_SHEET, STATUS_SHEET, LIMITS_SHEET]
+
+    write_limits = LIMITS_SHEET in names and limits_changed
+    if write_limits:
+        # only serialize the ledger when it has changed. New users are at the end, so adding
+        # one only adds a row rather than moving every row after it
+        limits_data = pd.DataFrame(list(limits.items()), columns=limits_data.columns)
+    else:
+        names = [name for name in names if name != LIMITS_SHEET]
+
+    frames = {
+        BOOKING_SHEET: booking_data,
+        STARTING_SHEET: starting_data,
+        STATUS_SHEET: status_data,
+        LIMITS_SHEET: limits_data,
+    }
+
+    data = []
+    new_snapshots = dict()
+    for name in names:
+        if frames[name] is None:
+            continue
+        if name == STATUS_SHEET:
+            # the status records are serialized directly, without going through a DataFrame
+            columns = status_data.columns.tolist()
+            new_snapshots[name] = [columns] + [
+                [str(v) for v in status.to_row(columns)] for status in printer_status
+            ]
+        else:
+            new_snapshots[name] = frame_rows(frames[name])
+        data += changed_ranges(name, new_snapshots[name])
+
+    if not data:
+        limits_changed = limits_changed and not write_limits
+        return True
 
-def write_limits_sheet():
     try:
-        limits_data.sort_values(by="CruzID", inplace=True)
-        vals = limits_data.values.tolist()
-        vals.insert(0, limits_data.columns.tolist())
-        _ = (
-            g_sheets.values()
-            .update(
+        _ = quota.execute(
+            g_sheets.values().batchUpdate(
                 spreadsheetId=SPREADSHEET_ID,
-                range=LIMITS_SHEET,
-                valueInputOption="USER_ENTERED",
-                body={"values": vals},
-            )
-            .execute()
+                body={"valueInputOption": "USER_ENTERED", "data": data},
+            ),
+            "write",
         )
+        sheet_snapshots.update(new_snapshots)
+        limits_changed = limits_changed and not write_limits
         return True
     except HttpError as e:
         logger.error(e)
         return False
 
 
-def get_limits_reset_date():
-    global limit_reset_date
-    try:
-        reset_date = (
-            g_sheets.values()
-            .get(spreadsheetId=SPREADSHEET_ID, range=LIMITS_RESET_DATE_SHEET)
-            .execute()
-        )
-
-        values = reset_date.get("values", [])
-
-        if not values:
-            logger.error("No reset date found.")
-            limit_reset_date = None
-            return
-
-        limit_reset_date = datetime.datetime.strptime(
-            values[0][0] + " 00:00:00", "%m/%d/%Y %H:%M:%S"
-        )
-    except HttpError as e:
-        logger.error(e)
-        exit(1)
-
-
 def clear_limits_sheet():
-    global limits_data
+    global limits_data, limits, limits_changed
     try:
-        _ = (
-            g_sheets.values()
-            .clear(
+        _ = quota.execute(
+            g_sheets.values().clear(
                 spreadsheetId=SPREADSHEET_ID,
                 range=LIMITS_SHEET + "!A2:B",
-            )
-            .execute()
+            ),
+            "write",
         )
         limits_data = pd.DataFrame(columns=limits_data.columns)
+        limits = dict()
+        limits_changed = False
+        sheet_snapshots[LIMITS_SHEET] = sheet_snapshots[LIMITS_SHEET][:1]
         return True
     except HttpError as e:
         logger.error(e)
@@ -355,13 +643,12 @@ def clear_limits_sheet():
 def clear_limits_reset_date():
     global limit_reset_date
     try:
-        _ = (
-            g_sheets.values()
-            .clear(
+        _ = quota.execute(
+            g_sheets.values().clear(
                 spreadsheetId=SPREADSHEET_ID,
                 range=LIMITS_RESET_DATE_SHEET,
-            )
-            .execute()
+            ),
+            "write",
         )
         limit_reset_date = None
         return True
@@ -370,6 +657,79 @@ def clear_limits_reset_date():
         return False
 
 
+class PrinterStatus:
+    """A printer's row in the status sheet. The status sheet is only read into these at startup,
+    after which they are the source of truth and the sheet is written from them."""
+
+    __slots__ = ("name", "status", "user", "start_time", "end_time")
+
+    def __init__(
+        self,
+        name: str,
+        status: int | None,
+        user: str = "",
+        start_time: datetime.datetime | None = None,
+        end_time: datetime.datetime | None = None,
+    ):
+        self.name = name
+        self.status = (
+            status  # one of the PRINTER_ constants, None if not a valid status
+        )
+        self.user = user
+        self.start_time = start_time
+        self.end_time = end_time
+
+    def to_row(self, columns):
+        values = {
+            "Printer Name": self.name,
+            "Status": printer_statuses[self.status] if self.status is not None else "",
+            "Current User": self.user,
+            "Start Time": (
+                self.start_time.strftime(STATUS_TIME_FORMAT) if self.start_time else ""
+            ),
+            "End Time": (
+                self.end_time.strftime(STATUS_TIME_FORMAT) if self.end_time else ""
+            ),
+        }
+        return [values.get(column, "") for column in columns]
+
+
+def parse_status_time(value: datetime.datetime | str):
+    # status sheet times only have minutes, so keep the same precision when comparing against them
+    if isinstance(value, datetime.datetime):
+        return value.replace(second=0, microsecond=0)
+    if not value.strip():
+        return None
+    return datetime.datetime.strptime(value.strip(), STATUS_TIME_FORMAT)
+
+
+def load_printer_status(frame):
+    # load the printer status records and name -> printer number map from the status sheet
+    global printer_status, printer_numbers
+    printer_status = []
+    for _, row in frame.iterrows():
+        try:
+            start_time = parse_status_time(row["Start Time"])
+            end_time = parse_status_time(row["End Time"])
+        except ValueError:
+            logger.warning(f"Invalid start or end time for {row['Printer Name']}")
+            start_time, end_time = None, None
+        printer_status.append(
+            PrinterStatus(
+                row["Printer Name"],
+                (
+                    printer_statuses.index(row["Status"])
+                    if row["Status"] in printer_statuses
+                    else None
+                ),
+                row["Current User"].strip(),
+                start_time,
+                end_time,
+            )
+        )
+    printer_numbers = {status.name: i for i, status in enumerate(printer_status)}
+
+
 def update_printer_status(
     printer_num: int | None,
     status_num: int | None,
@@ -377,554 +737,832 @@ def update_printer_status(
     start_time: datetime.datetime | str | None,
     end_time: datetime.datetime | str | None,
 ):
+    # None leaves a field unchanged, and "" clears it
+    status = printer_status[printer_num]
     if status_num is not None:
-        status_data.loc[printer_num, "Status"] = printer_statuses[status_num]
+        status.status = status_num
+    if status_num == PRINTER_AVAILABLE and printer_num in printer_over_limit:
+        # the over limit print is over, so the next print on the printer is not canceled for it
+        printer_over_limit.remove(printer_num)
     if user is not None:
-        status_data.loc[printer_num, "Current User"] = user
+        status.user = user
     if start_time is not None:
-        if type(start_time) == datetime.datetime:
-            status_data.loc[printer_num, "Start Time"] = start_time.strftime(
-                "%Y-%m-%d %H:%M"
-            )
-        else:
-            status_data.loc[printer_num, "Start Time"] = start_time
+        status.start_time = parse_status_time(start_time)
     if end_time is not None:
-        if type(end_time) == datetime.datetime:
-            status_data.loc[printer_num, "End Time"] = end_time.strftime(
-                "%Y-%m-%d %H:%M"
-            )
-        else:
-            status_data.loc[printer_num, "End Time"] = end_time
+        status.end_time = parse_status_time(end_time)
 
 
 def print_weight(cruzid, weight):
-    global limits_data
+    """Take weight grams from the user's filament limit.
+    Returns: None if no weight was given, False if the user does not have enough left, otherwise True
+    """
+    global limits_changed
     if not weight:
         return None
     weight = int(weight)
-    if limits_data.empty or cruzid not in limits_data.loc[:, "CruzID"].values:
-        row = pd.DataFrame([{"CruzID": cruzid, "Limit (grams)": 1000}])
-        limits_data = pd.concat([limits_data, row], ignore_index=True)
-
-    remaining = int(
-        limits_data.loc[limits_data.loc[:, "CruzID"] == cruzid, "Limit (grams)"].values[
-            0
-        ]
-    )
+    if cruzid not in limits:
+        limits[cruzid] = DEFAULT_LIMIT
+        limits_changed = True
 
-    if weight > remaining:
+    if weight > limits[cruzid]:
         return False
     else:
-        limits_data.loc[limits_data.loc[:, "CruzID"] == cruzid, "Limit (grams)"] = (
-            remaining - weight
-        )
+        limits[cruzid] -= weight
+        limits_changed = True
         return True
 
 
-if __name__ == "__main__":
-    try:
-        # get data from Access Card sheet (3D printer access, staff members)
-        sheet.get_sheet_data(False)
-        # get data from printer automations sheet (bookings, startings, statuses, limits, logs)
-        get_sheet_data()
+def log_printer(i, printer_name, printer):
+    # the messages are only built if they are logged
+    logger.info("Printer %d: %s", i, printer_name)
+
+    if printer._lastMessageTime:
+        logger.info(
+            "last checkin: %ds ago", round(time.time() - printer._lastMessageTime)
+        )
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(
+            "tool=[%s/%s] bed=[%s/%s] fan=[%s] print=[%s] speed=[%s] light=[%s]",
+            round(printer.tool_temp, 1),
+            round(printer.tool_temp_target, 1),
+            round(printer.bed_temp, 1),
+            round(printer.bed_temp_target, 1),
+            parseFan(printer.fan_speed),
+            printer.gcode_state,
+            printer.speed_level,
+            "on" if printer.light_state else "off",
+        )
+        logger.debug(
+            "stg_cur=[%s] file=[%s] layer=[%s/%s] %%=[%s] eta=[%s min] spool=[%s (%s)]",
+            parseStage(printer.current_stage),
+            printer.gcode_file,
+            printer.current_layer,
+            printer.layer_count,
+            printer.percent_complete,
+            printer.time_remaining,
+            printer.active_spool,
+            printer.spool_state,
+        )
 
-        # clear all printer statuses
-        for i, _ in enumerate(printers):
-            update_printer_status(i, PRINTER_AVAILABLE, "", "", "")
 
-        # set up printers
-        for name in printer_data:
-            # get printer config from json file
-            p = printer_data[name]
-            # check if all required fields are present
-            if (
-                "hostname" not in p
-                or "access_code" not in p
-                or "serial_number" not in p
+def check_printer(i, timestamp):
+    """Check the state of printer i against its status in the status sheet - cancel prints that
+    break the rules, record prints that have started or finished, and book the printer for the
+    next user waiting if it is available."""
+    printer_name, printer = printers[i]
+    # this runs for every printer every second, so the printer is only logged when its state
+    # changes
+    state = (printer.gcode_state, printer.current_stage, printer.gcode_file)
+    if logged_printer_states.get(i) != state:
+        logged_printer_states[i] = state
+        log_printer(i, printer_name, printer)
+
+    status = printer_status[i]
+
+    if status.status == PRINTER_OFFLINE and printer.state == PrinterState.CONNECTED:
+        # the printer is reporting its state again, e.g. it connected after timing out at startup
+        update_printer_status(i, PRINTER_AVAILABLE, "", "", "")
+
+    if printer.gcode_state in ["RUNNING", "PAUSE"]:
+        # if printer is currently printing
+
+        # get user who booked/started the print (could be blank)
+        user = status.user
+
+        if (status.status == PRINTER_PRINTING) and (
+            (
+                status.start_time is not None
+                and status.start_time
+                <= timestamp - datetime.timedelta(minutes=TIME_TO_START)
+                and (
+                    not user.strip()
+                    or booking_data.loc[
+                        currently_booked_or_printing[user],
+                        "Status",
+                    ]
+                    == booking_statuses[USER_BOOKED]
+                )
+            )
+            or (
+                printer.tool_temp_target > MAX_TOOL_TEMP
+                and not access.is_staff(user.strip())
+            )
+            or (i in printer_over_limit)
+        ):
+            reason = ""
+            if not user.strip():
+                reason = "no user"
+            elif (
+                booking_data.loc[
+                    currently_booked_or_printing[user],
+                    "Status",
+                ]
+                == booking_statuses[USER_BOOKED]
+            ):
+                reason = "start form not submitted"
+            elif printer.tool_temp_target > MAX_TOOL_TEMP and not access.is_staff(
+                user.strip()
             ):
-                logger.error(
-                    f"Error: printer config for {name} missing hostname, access_code, or serial_number"
+                reason = "tool temp too high"
+            elif i in printer_over_limit:
+                reason = "over quarterly filament limit"
+
+            # if printer has been printing for more than 10 minutes and no user is recorded
+            # or they didn't submit a start form
+            # or the tool temp is too high (and they're not staff)
+            # or they're over their weight limit
+            # TODO: cancel print
+            # printer.stop_printing()
+            if user.strip():
+                gmail_queue_message(
+                    recipient=user.strip() + "@ucsc.edu",
+                    sender=EMAIL_SENDER,
+                    subject="Slugworks 3D Printing - Print Canceled",
+                    body=f"Your print on {printer_name} was canceled because: {reason}. Please contact Slugworks staff if you have any questions.",
+                    cc=EMAIL_CC,
+                    reply_to=EMAIL_REPLY_TO,
                 )
-                exit(1)
+            # TODO: log cancelation
+            logger.warning("cancel! - " + reason)
+            cancellations.inc(reason=reason)
+            status.status = PRINTER_CANCEL_PENDING
+
+        if status.status == PRINTER_AVAILABLE:
+            # if printer is printing but status was set to available
+            # a print must have been started without a booking
+            print_without_booking[printer_name] = (
+                i,
+                datetime.datetime.fromtimestamp(printer.start_time * 60),
+            )
+        elif status.status == PRINTER_BOOKED:
+            # if printer is printing but status was set to booked
+            # a print must have been started with a booking (but may not have been started by the user who booked it)
+            print_with_booking[printer_name] = (
+                i,
+                user,
+                currently_booked_or_printing[user],
+                datetime.datetime.fromtimestamp(printer.start_time * 60),
+            )
+
+        # update printer status in status sheet
+        update_printer_status(
+            i,  # printer number
+            (
+                PRINTER_PRINTING if status.status != PRINTER_CANCEL_PENDING else None
+            ),  # set status to printing, unless it is cancel pending (in which case leave it)
+            None,  # do not change the user
+            datetime.datetime.fromtimestamp(
+                printer.start_time * 60
+            ),  # set start time to the time the print started
+            timestamp
+            + datetime.timedelta(
+                minutes=printer.time_remaining
+            ),  # set end time to the time the print will finish
+        )
+    elif status.status == PRINTER_PRINTING:
+        # if printer just finished printing
+        # get user who booked/started the print
+        user = status.user.strip()
+        # if user is currently printing
+        if user and user in currently_booked_or_printing:
+            # add user to list of completed prints
+            complete_prints.append(user)
+        # set printer status to available
+        update_printer_status(i, PRINTER_AVAILABLE, "", "", "")
+    elif status.status is None or status.status == PRINTER_CANCEL_PENDING:
+        # if printer is not printing but no valid status is recorded, or if print was canceled
+        # set printer status to available
+        update_printer_status(i, PRINTER_AVAILABLE, "", "", "")
+
+    # if printer is available and someone is waiting for a printer (or it was prebooked)
+    if status.status == PRINTER_AVAILABLE and (i in prebooked or waiting_for_printer):
+        # the booking starts when the lab is next open, and lasts BOOKING_TIME hours of opening hours
+        start_time = lab_calendar.next_open(timestamp)
+        end_time = lab_calendar.add_open_time(
+            start_time, datetime.timedelta(hours=BOOKING_TIME)
+        )
 
-            # create printer config object using IP, access code, and serial number
-            config = BambuConfig(
-                hostname=p["hostname"],
-                access_code=p["access_code"],
-                serial_number=p["serial_number"],
+        if i in prebooked:
+            # the user who was told they are next on this printer, who is already counted as booked
+            user = prebooked.pop(i)
+            row = currently_booked_or_printing[user]
+        else:
+            # get first user waiting for a printer, and row number of user in booking_data
+            user, row = waiting_for_printer.dequeue()
+        # update printer status in status sheet
+        update_printer_status(
+            i,  # printer number
+            PRINTER_BOOKED,  # set status to booked
+            user,  # set user to the user who booked the printer
+            start_time,
+            end_time,
+        )
+        # add user to currently booked or printing users
+        currently_booked_or_printing[user] = row
+        # update booking status in booking sheet
+        booking_data.loc[row, "Status"] = booking_statuses[USER_BOOKED]
+        if ESTIMATED_START_COLUMN in booking_data.columns:
+            booking_data.loc[row, ESTIMATED_START_COLUMN] = ""
+        gmail_queue_message(
+            recipient=user + "@ucsc.edu",
+            sender=EMAIL_SENDER,
+            subject="Slugworks 3D Printing - Booked",
+            body=f"It's your turn to print on {printer_name}! Start your print before {end_time.strftime('%I:%M %p')} on {end_time.strftime('%m/%d')}.",
+            cc=EMAIL_CC,
+            reply_to=EMAIL_REPLY_TO,
+        )
+        logger.warning("booked!")
+    elif (
+        status.status == PRINTER_BOOKED
+        and status.end_time is not None
+        and timestamp >= status.end_time
+    ):
+        # if printer is booked but booking time has expired
+        # get user who booked the printer
+        user = status.user
+        row = currently_booked_or_printing.pop(user)
+        # update printer status in status sheet to available
+        update_printer_status(i, PRINTER_AVAILABLE, "", "", "")
+        # update booking status in booking sheet to did not start print
+        booking_data.loc[row, "Status"] = booking_statuses[USER_NO_START]
+
+
+def handle_starting_forms(timestamp):
+    """Match start form submissions from the last TIME_TO_START minutes to the printers
+    that have started prints."""
+    if not print_without_booking and not print_with_booking:
+        # no started prints are waiting for a start form
+        return
+
+    # the first row submitted within the last TIME_TO_START minutes
+    first = bisect.bisect_right(
+        starting_times, timestamp - datetime.timedelta(minutes=TIME_TO_START)
+    )
+    for i in starting_data.index.values[first:][::-1]:
+        # iterate through the recent starting data in reverse order
+
+        if starting_data.loc[i, "Handled"] == "TRUE":
+            # if the starting data has already been handled, skip
+            continue
+
+        # get cruzid, printer name, and weight (grams) from starting data
+        cruzid = starting_data.loc[i, "Email Address"].split("@")[0].strip()
+        printer = starting_data.loc[i, "Printer"]
+        weight = starting_data.loc[i, "Weight"]
+
+        if printer in print_without_booking and access.is_staff(cruzid):
+            # if printer has started a print without a booking and the user is staff
+            printer_num, start_time = print_without_booking.pop(printer)
+            # update printer status in status sheet to add the user
+            update_printer_status(printer_num, None, cruzid, None, None)
+            # update starting data to show that it has been handled
+            starting_data.loc[i, "Handled"] = "TRUE"
+        elif printer in print_with_booking:
+            # if printer has started a print with a booking
+            # get the print data
+            printer_num, user, row, start_time = print_with_booking[printer]
+            if cruzid == user.strip():
+                # if the user who booked the printer is the one from the start form
+                # update booking status in booking sheet to currently printing
+                booking_data.loc[row, "Status"] = booking_statuses[USER_PRINTING]
+                # remove printer from printers that have started prints with a booking
+                print_with_booking.pop(printer)
+                # set starting data to handled
+                starting_data.loc[i, "Handled"] = "TRUE"
+
+                if (
+                    print_weight(cruzid, weight) is False
+                    and printer_num not in printer_over_limit
+                ):
+                    # if the user has exceeded their weight limit (a blank weight is not checked)
+                    printer_over_limit.append(printer_num)
+                # TODO: log print
+            elif access.is_staff(cruzid):
+                # if the user who started the print is staff
+                # update booking status in booking sheet to supervised printing
+                booking_data.loc[row, "Status"] = booking_statuses[USER_SUPERVISED]
+                # remove printer from printers that have started prints with a booking
+                print_with_booking.pop(printer)
+                # set starting data to handled
+                starting_data.loc[i, "Handled"] = "TRUE"
+
+                if (
+                    print_weight(cruzid, weight) is False
+                    and printer_num not in printer_over_limit
+                ):
+                    # if the user has exceeded their weight limit (a blank weight is not checked)
+                    printer_over_limit.append(printer_num)
+                # TODO: log print
+
+
+def handle_bookings():
+    """Add newly submitted (certified) bookings to the waiting list, mark completed prints as
+    done, and move booking_index to the first row that is still active."""
+    global booking_index
+
+    # booking data starting from the first active index
+    active = booking_data.iloc[booking_index:]
+    # get cruzids from email addresses
+    cruzids = active["Email Address"].str.split("@").str[0]
+
+    # check whether each user is staff or has access to 3D printing once, rather than for every row
+    certified_users = {
+        cruzid
+        for cruzid in cruzids.unique()
+        if access.is_staff(cruzid) or access.has_access("3D Printing", cruzid)
+    }
+    certified = cruzids.isin(certified_users)
+    # bookings whose status is blank or waiting for printer
+    pending = active["Status"].isin(["", booking_statuses[USER_WAITING]])
+
+    # set certified users to waiting for printer, and everyone else to not certified
+    booking_data.loc[active.index[pending & certified], "Status"] = booking_statuses[
+        USER_WAITING
+    ]
+    booking_data.loc[active.index[pending & ~certified], "Status"] = booking_statuses[
+        USER_NOT_CERTIFIED
+    ]
+
+    # first waiting booking of each user who is not currently booked or printing and not already waiting
+    queued = waiting_for_printer.users.keys() | currently_booked_or_printing.keys()
+    new_bookings = cruzids[
+        pending & certified & ~cruzids.isin(queued)
+    ].drop_duplicates()
+
+    for i, cruzid in new_bookings.items():
+        # add the user to the queue of users waiting for a printer & save the row number
+        waiting_for_printer.enqueue(cruzid, i)
+        gmail_queue_message(
+            recipient=cruzid + "@ucsc.edu",
+            sender=EMAIL_SENDER,
+            subject="Slugworks 3D Printing - Waiting",
+            body="You are now waiting for a 3D printer at Slugworks. You will receive an email when a printer is booked for you to use.",
+            cc=EMAIL_CC,
+            reply_to=EMAIL_REPLY_TO,
+        )
+        # TODO: log addition to queue
+        logger.warning("waiting!")
+
+    if complete_prints:
+        # users who are currently printing and have completed their print (and this is their booking row)
+        done = (
+            active["Status"].isin(
+                [booking_statuses[USER_PRINTING], booking_statuses[USER_SUPERVISED]]
             )
-            # create printer object using config
-            printer = BambuPrinter(config=config)
-            # add printer to list of printers
-            printers.append((name, printer))
-            # start session with printer
-            printer.start_session()
-            if printer.state == PrinterState.QUIT:
-                logger.error(f"Error: could not connect to {name} at {p['hostname']}")
-                status_data.loc[status_data["Printer Name"] == name, "Status"] = (
-                    printer_statuses[PRINTER_OFFLINE]
-                )
+            & cruzids.isin(complete_prints)
+            & (cruzids.map(currently_booked_or_printing) == active.index.to_series())
+        )
+        # set the users to print done
+        booking_data.loc[active.index[done], "Status"] = booking_statuses[USER_DONE]
+        # remove the users from the currently booked or printing users
+        for cruzid in cruzids[done]:
+            currently_booked_or_printing.pop(cruzid)
+
+    # completed prints that did not match a booking row are not carried over to the next sync
+    complete_prints.clear()
+
+    # set the first active index to the first row whose booking status is one of the active statuses
+    is_active = booking_data.loc[active.index, "Status"].isin(
+        booking_statuses[USER_WAITING : (USER_SUPERVISED + 1)]
+    )
+    if is_active.any():
+        booking_index = int(is_active.idxmax())
+
+
+def printer_free_time(i, timestamp):
+    """Predict when printer i can next be booked, or None if it can't be."""
+    printer = printers[i][1]
+    status = printer_status[i]
+    if status.status == PRINTER_OFFLINE or printer.state == PrinterState.QUIT:
+        return None
+    if printer.gcode_state in ["RUNNING", "PAUSE"]:
+        return timestamp + datetime.timedelta(minutes=printer.time_remaining or 0)
+    if status.status == PRINTER_BOOKED and status.end_time is not None:
+        # the booked user may start a print any time until then
+        return max(status.end_time, timestamp)
+    return timestamp
+
+
+def round_up(time, minutes):
+    # round a time up to a multiple of minutes past the hour
+    rounded = time.replace(second=0, microsecond=0)
+    rounded += datetime.timedelta(minutes=-rounded.minute % minutes)
+    return rounded if rounded >= time else rounded + datetime.timedelta(minutes=minutes)
+
+
+def assign_printers(timestamp):
+    """Tell the next users which printers will be theirs when their prints are about to end,
+    and estimate when every waiting user can start."""
+    free_times = {
+        i: free
+        for i in range(len(printers))
+        if (free := printer_free_time(i, timestamp)) is not None
+    }
+
+    # users prebooked on printers that went offline wait for another printer again, keeping
+    # their place at the front of the queue (the last one prebooked goes back first, so they
+    # stay in the order they were taken off it)
+    for i in reversed([i for i in prebooked if i not in free_times]):
+        user = prebooked.pop(i)
+        waiting_for_printer.requeue_front(user, currently_booked_or_printing.pop(user))
+
+    # prebook the printers that free up soonest, if their print ends within PREBOOK_WINDOW
+    # minutes while the lab is open, so the next user can be there when it does
+    for i in sorted(free_times, key=free_times.get):
+        if not waiting_for_printer:
+            break
+        free = free_times[i]
+        if free > timestamp + datetime.timedelta(minutes=PREBOOK_WINDOW):
+            break
+        if (
+            i in prebooked
+            or printer_status[i].status != PRINTER_PRINTING
+            or not lab_calendar.is_open(free)
+        ):
+            continue
+        user, row = waiting_for_printer.dequeue()
+        prebooked[i] = user
+        # counted as booked, so a new booking from them is not queued
+        currently_booked_or_printing[user] = row
+        gmail_queue_message(
+            recipient=user + "@ucsc.edu",
+            sender=EMAIL_SENDER,
+            subject="Slugworks 3D Printing - Up Next",
+            body=f"You're next on {printers[i][0]}, which should be free at {free.strftime('%I:%M %p')}. You will get another email when it is booked for you.",
+            cc=EMAIL_CC,
+            reply_to=EMAIL_REPLY_TO,
+        )
+        logger.warning("prebooked!")
+
+    if ESTIMATED_START_COLUMN not in booking_data.columns:
+        return
+
+    # prebooked printers are taken until their users' bookings are over
+    usage = datetime.timedelta(hours=EXPECTED_USAGE)
+    rows, starts = [], []
+    for i, user in prebooked.items():
+        rows.append(currently_booked_or_printing[user])
+        starts.append(free_times.get(i, timestamp))
+        if i in free_times:
+            free_times[i] += usage
+
+    users = list(waiting_for_printer)
+    rows += [waiting_for_printer.row(user) for user in users]
+    starts += assignment.estimate_starts(
+        free_times.values(), len(users), lab_calendar, usage
+    )
+
+    # many users share an estimate, so format each one once, and set every estimate at once
+    # rather than one cell at a time
+    formatted = {}
+    for start in starts:
+        if start not in formatted:
+            formatted[start] = (
+                round_up(start, ESTIMATE_RESOLUTION).strftime(STATUS_TIME_FORMAT)
+                if start is not None
+                else ""
+            )
+    if rows:
+        booking_data.loc[rows, ESTIMATED_START_COLUMN] = [
+            formatted[start] for start in starts
+        ]
+
+
+def sync_sheets():
+    """Read the sheets, handle start forms and bookings, and write the changes back.
+    Returns False if the pending changes could not be written or the sheets could not be read.
+    """
+    # write changes made while handling printer events, before the read overwrites them
+    with phase_seconds.time(phase="write pending"):
+        if not write_sheet_data():
+            # reading now would replace the changes that could not be written
+            logger.error("Could not write pending changes, skipping sync.")
+            return False
+
+    # get data from Access Card sheet (3D printer access, staff members) if it has changed
+    with phase_seconds.time(phase="access"):
+        access.refresh()
+
+    # get data from printer automations sheet (bookings, startings, statuses, limits)
+    with phase_seconds.time(phase="read"):
+        if not get_sheet_data():
+            logger.error("Could not read sheets, skipping sync.")
+            return False
+
+    with phase_seconds.time(phase="starting forms"):
+        handle_starting_forms(now())
+    with phase_seconds.time(phase="bookings"):
+        handle_bookings()
+    with phase_seconds.time(phase="assignment"):
+        assign_printers(now())
+
+    # write changed rows to sheets
+    with phase_seconds.time(phase="write"):
+        write_sheet_data()
+
+    with phase_seconds.time(phase="checkpoint"):
+        checkpoint()
+    return True
+
+
+def check_printers():
+    """Check every printer, for changes that are not pushed as printer events, e.g. bookings
+    that have expired."""
+    timestamp = now()
+    with phase_seconds.time(phase="printers"):
+        for i in range(len(printers)):
+            check_printer(i, timestamp)
+    with phase_seconds.time(phase="checkpoint"):
+        checkpoint()
+
+
+def check_limits_reset():
+    """Merge staff edits to the Filament Limits sheet into the ledger, and clear the limits if
+    the limits reset date has passed. Returns False if the sheets could not be read."""
+    # write the ledger's changes first, so the rows that differ when it is read were edited by staff
+    if not write_sheet_data([LIMITS_SHEET]):
+        return False
+    if not get_sheet_data([LIMITS_RESET_DATE_SHEET, LIMITS_SHEET]):
+        return False
+
+    # check if the limits reset date has passed
+    if limit_reset_date is not None and now() >= limit_reset_date:
+        # if the limits reset date has passed, clear the limits sheet and reset the reset date
+        clear_limits_sheet()
+        clear_limits_reset_date()
+
+
+def set_printer_offline(name, reason=None):
+    # mark a printer that could not be connected to as offline in the status sheet
+    logger.error(
+        f"Error: could not connect to {name} at {printer_data[name]['hostname']}"
+        + (f" ({reason})" if reason else "")
+    )
+    if name in printer_numbers:
+        printer_status[printer_numbers[name]].status = PRINTER_OFFLINE
+
+
+def printer_update_callback(i):
+    """Create the update callback for printer i. bpm calls it from the printer's MQTT thread on
+    every message, so it only queues an event when the print state or target tool temperature
+    changes - the event is handled by the main thread."""
+
+    name = printers[i][0]
+
+    def on_update(printer):
+        if telemetry is not None:
+            telemetry.record(name, printer, now().timestamp())
+        state = (printer.gcode_state, printer.tool_temp_target)
+        if printer_event_states.get(i) != state:
+            printer_event_states[i] = state
+            printer_events.put((i,) + state)
+
+    return on_update
+
+
+def handle_printer_events(timeout: float):
+    """Check printers as soon as their state changes, for the given number of seconds, and then
+    any changes that are already queued."""
+    until = time.monotonic() + timeout
+    while True:
+        timeout = until - time.monotonic()
+        try:
+            # once the time is up, only handle events that are already queued
+            if timeout > 0:
+                event = printer_events.get(timeout=timeout)
             else:
-                logger.info(f"Connected to {name} at {p['hostname']}")
+                event = printer_events.get_nowait()
+        except queue.Empty:
+            return
+        i, gcode_state, tool_temp_target = event
+
+        logger.info(
+            "%s changed: print=[%s] tool_target=[%s]",
+            printers[i][0],
+            gcode_state,
+            tool_temp_target,
+        )
+        try:
+            with phase_seconds.time(phase="printer event"):
+                check_printer(i, now())
+                checkpoint()
+        except Exception as e:
+            logger.error(f"Error handling {printers[i][0]} event: {e}")
+
+
+def format_state_time(time: datetime.datetime | None):
+    return time.isoformat() if time is not None else None
+
+
+def parse_state_time(time: str | None):
+    return datetime.datetime.fromisoformat(time) if time is not None else None
+
+
+def checkpoint():
+    """Save the scheduler state to the state store. Only the parts that changed are written."""
+    state_store.save(
+        {
+            "booking_index": booking_index,
+            "waiting_for_printer": waiting_for_printer.to_list(),
+            "currently_booked_or_printing": currently_booked_or_printing,
+            "print_without_booking": [
+                [name, num, format_state_time(start_time)]
+                for name, (num, start_time) in print_without_booking.items()
+            ],
+            "print_with_booking": [
+                [name, num, user, row, format_state_time(start_time)]
+                for name, (
+                    num,
+                    user,
+                    row,
+                    start_time,
+                ) in print_with_booking.items()
+            ],
+            "printer_over_limit": printer_over_limit,
+            "complete_prints": complete_prints,
+            "prebooked": [[i, user] for i, user in prebooked.items()],
+            "printer_status": [
+                [
+                    status.name,
+                    status.status,
+                    status.user,
+                    format_state_time(status.start_time),
+                    format_state_time(status.end_time),
+                ]
+                for status in printer_status
+            ],
+        }
+    )
 
-        # check if number of printers in printers.json matches number of printers in status sheet
-        if len(printers) != len(status_data):
+
+def restore_state():
+    """Resume from the last checkpoint in the state store. Returns False if there is no
+    checkpoint, or it is for a different set of printers than the status sheet."""
+    global booking_index, waiting_for_printer
+    state = state_store.load()
+    if "printer_status" not in state:
+        return False
+    if [row[0] for row in state["printer_status"]] != [s.name for s in printer_status]:
+        logger.warning(
+            "Printers changed since the last checkpoint, not resuming from it."
+        )
+        return False
+
+    booking_index = state["booking_index"]
+    waiting_for_printer = BookingQueue.from_list(state["waiting_for_printer"])
+    currently_booked_or_printing.update(state["currently_booked_or_printing"])
+    for name, num, start_time in state["print_without_booking"]:
+        print_without_booking[name] = (num, parse_state_time(start_time))
+    for name, num, user, row, start_time in state["print_with_booking"]:
+        print_with_booking[name] = (num, user, row, parse_state_time(start_time))
+    printer_over_limit.extend(state["printer_over_limit"])
+    complete_prints.extend(state["complete_prints"])
+    prebooked.update({i: user for i, user in state.get("prebooked", [])})
+    for status, (_, num, user, start_time, end_time) in zip(
+        printer_status, state["printer_status"]
+    ):
+        status.status = num
+        status.user = user
+        status.start_time = parse_state_time(start_time)
+        status.end_time = parse_state_time(end_time)
+    return True
+
+
+def start():
+    """Read the sheets, resume from the last checkpoint and connect to the printers."""
+    global telemetry
+    # get data from Access Card sheet (3D printer access, staff members)
+    access.refresh(force=True)
+    # get data from printer automations sheet (bookings, startings, statuses, limits)
+    if not get_sheet_data():
+        logger.error("Could not read printer automations sheet.")
+        exit(1)
+
+    # resume from the last checkpoint instead of rebuilding the queue and statuses from the sheets
+    if restore_state():
+        logger.info(
+            f"Resumed from checkpoint with {len(waiting_for_printer)} users waiting"
+        )
+    else:
+        # clear all printer statuses
+        for i, _ in enumerate(printers):
+            update_printer_status(i, PRINTER_AVAILABLE, "", "", "")
+
+    # set up printers
+    for name in printer_data:
+        # get printer config from json file
+        p = printer_data[name]
+        # check if all required fields are present
+        if "hostname" not in p or "access_code" not in p or "serial_number" not in p:
             logger.error(
-                f"Error: number of printers in printers.json ({len(printers)}) does not match number of printers in status sheet ({len(status_data)})"
+                f"Error: printer config for {name} missing hostname, access_code, or serial_number"
             )
             exit(1)
 
-        # sort printers by their order in the status sheet
-        printers.sort(
-            key=lambda x: status_data.loc[status_data["Printer Name"] == x[0]].index[0]
+        # create printer config object using IP, access code, and serial number
+        config = BambuConfig(
+            hostname=p["hostname"],
+            access_code=p["access_code"],
+            serial_number=p["serial_number"],
+        )
+        # create printer object using config
+        printer = BambuPrinter(config=config)
+        # add printer to list of printers
+        printers.append((name, printer))
+
+    # start sessions with all printers at once, so an unreachable printer does not hold up the others
+    # and startup takes as long as the slowest printer rather than all of them combined
+    executor = ThreadPoolExecutor(max_workers=max(len(printers), 1))
+    sessions = {
+        executor.submit(printer.start_session): (name, printer)
+        for name, printer in printers
+    }
+    try:
+        for session in as_completed(sessions, timeout=STARTUP_TIMEOUT):
+            name, printer = sessions[session]
+            if session.exception() is None and printer.state != PrinterState.QUIT:
+                logger.info(f"Connected to {name} at {printer_data[name]['hostname']}")
+                if (
+                    name in printer_numbers
+                    and printer_status[printer_numbers[name]].status == PRINTER_OFFLINE
+                ):
+                    # it may have been offline when the last checkpoint was made
+                    update_printer_status(
+                        printer_numbers[name], PRINTER_AVAILABLE, "", "", ""
+                    )
+            else:
+                set_printer_offline(name, session.exception())
+    except TimeoutError:
+        for session, (name, printer) in sessions.items():
+            if not session.done():
+                set_printer_offline(name, "timed out")
+    # do not wait for sessions that timed out
+    executor.shutdown(wait=False)
+
+    # check if number of printers in printers.json matches number of printers in status sheet
+    if len(printers) != len(printer_status):
+        logger.error(
+            f"Error: number of printers in printers.json ({len(printers)}) does not match number of printers in status sheet ({len(printer_status)})"
         )
+        exit(1)
+    for name, _ in printers:
+        if name not in printer_numbers:
+            logger.error(f"Error: printer {name} is not in the status sheet")
+            exit(1)
 
-        # write available/offline status to sheet
-        write_status_sheet()
+    # sort printers by their order in the status sheet
+    printers.sort(key=lambda x: printer_numbers[x[0]])
 
-        waiting_for_printer = []  # users who are waiting for printer
-        waiting_for_printer_rows = (
-            dict()
-        )  # row numbers (in booking_data) of users who are waiting for printer
+    # record the telemetry pushed by the printers, for windowed queries of their recent history
+    telemetry = Telemetry([name for name, _ in printers], TELEMETRY_PATH)
 
-        currently_booked_or_printing = []  # users who are currently booked or printing
-        currently_booked_or_printing_rows = (
-            dict()
-        )  # row numbers (in booking_data) of users who are currently booked or printing
+    # react to printer state changes as they are pushed, rather than only on every sync
+    for i, (_, printer) in enumerate(printers):
+        printer.on_update = printer_update_callback(i)
 
-        print_without_booking = (
-            []
-        )  # printers that have started prints without a booking
-        print_without_booking_data = (
-            dict()
-        )  # data for printers that have started prints without a booking - printer num, start time
+    # write available/offline status to sheet
+    write_sheet_data([STATUS_SHEET])
 
-        print_with_booking = []  # printers that have started prints with a booking
-        print_with_booking_data = (
-            dict()
-        )  # data for printers that have started prints with a booking - printer num, user (from status_data), row number in booking_data, start time
 
-        printer_over_limit = (
-            []
-        )  # printers that have started prints with a booking but are over their weight limit
+def create_scheduler(wait=time.sleep, clock=time.monotonic):
+    """Create the scheduler for the printer, sync and limits reset jobs. wait is called with the
+    seconds until the next job is due."""
+    # each job runs at its own interval, and backs off on its own if it keeps failing
+    scheduler = Scheduler(wait, clock)
+    scheduler.add_job("printers", check_printers, PRINTER_INTERVAL)
+    scheduler.add_job("sync", sync_sheets, SYNC_INTERVAL)
+    scheduler.add_job("limits reset", check_limits_reset, LIMITS_RESET_INTERVAL)
+    scheduler.add_job(
+        "telemetry snapshot", telemetry.snapshot, TELEMETRY_SNAPSHOT_INTERVAL
+    )
+    return scheduler
 
-        while True:
-            try:
-                # get data from Access Card sheet (3D printer access, staff members)
-                sheet.get_sheet_data(False)
-
-                # get data from printer automations sheet (bookings, startings, statuses, limits, logs)
-                get_sheet_data()
-
-                # get current timestamp to be used for calculations
-                timestamp = datetime.datetime.now()
-
-                # check if the limits reset date has passed
-                get_limits_reset_date()
-                if limit_reset_date is not None and timestamp >= limit_reset_date:
-                    # if the limits reset date has passed, clear the limits sheet and reset the reset date
-                    clear_limits_sheet()
-                    clear_limits_reset_date()
-
-                # list of users who have completed their prints and their row numbers
-                complete_prints = []
-
-                for i, (printer_name, printer) in enumerate(printers):
-                    logger.info(f"Printer {i}: {printer_name}")
-
-                    if printer._lastMessageTime:
-                        logger.info(
-                            f"last checkin: {round(time.time() - printer._lastMessageTime)}s ago"
-                        )
-                    logger.debug(
-                        f"tool=[{round(printer.tool_temp, 1)}/{round(printer.tool_temp_target, 1)}] "
-                        + f"bed=[{round(printer.bed_temp, 1)}/{round(printer.bed_temp_target, 1)}] "
-                        + f"fan=[{parseFan(printer.fan_speed)}] print=[{printer.gcode_state}] speed=[{printer.speed_level}] "
-                        + f"light=[{'on' if printer.light_state else 'off'}]"
-                    )
-                    logger.debug(
-                        f"stg_cur=[{parseStage(printer.current_stage)}] file=[{printer.gcode_file}] "
-                        + f"layer=[{printer.current_layer}/{printer.layer_count}] "
-                        + f"%=[{printer.percent_complete}] eta=[{printer.time_remaining} min] "
-                        + f"spool=[{printer.active_spool} ({printer.spool_state})]"
-                    )
 
-                    if printer.gcode_state in ["RUNNING", "PAUSE"]:
-                        # if printer is currently printing
-
-                        # get user who booked/started the print (could be blank)
-                        user = status_data.loc[i, "Current User"]
-
-                        if (
-                            status_data.loc[i, "Status"]
-                            == printer_statuses[PRINTER_PRINTING]
-                        ) and (
-                            (
-                                datetime.datetime.strptime(
-                                    status_data.loc[i, "Start Time"].strip() + ":00",
-                                    "%Y-%m-%d %H:%M:%S",
-                                )
-                                <= timestamp - datetime.timedelta(minutes=TIME_TO_START)
-                                and (
-                                    not user.strip()
-                                    or booking_data.loc[
-                                        currently_booked_or_printing_rows[user],
-                                        "Status",
-                                    ]
-                                    == booking_statuses[USER_BOOKED]
-                                )
-                            )
-                            or (
-                                printer.tool_temp_target > MAX_TOOL_TEMP
-                                and not sheet.is_staff(cruzid=user.strip())
-                            )
-                            or (i in printer_over_limit)
-                        ):
-                            reason = ""
-                            if not user.strip():
-                                reason = "no user"
-                            elif (
-                                booking_data.loc[
-                                    currently_booked_or_printing_rows[user],
-                                    "Status",
-                                ]
-                                == booking_statuses[USER_BOOKED]
-                            ):
-                                reason = "start form not submitted"
-                            elif (
-                                printer.tool_temp_target > MAX_TOOL_TEMP
-                                and not sheet.is_staff(cruzid=user.strip())
-                            ):
-                                reason = "tool temp too high"
-                            elif i in printer_over_limit:
-                                reason = "over quarterly filament limit"
-
-                            # if printer has been printing for more than 10 minutes and no user is recorded
-                            # or they didn't submit a start form
-                            # or the tool temp is too high (and they're not staff)
-                            # or they're over their weight limit
-                            # TODO: cancel print
-                            # printer.stop_printing()
-                            if user.strip():
-                                gmail_send_message(
-                                    recipient=user.strip() + "@ucsc.edu",
-                                    sender=EMAIL_SENDER,
-                                    subject="Slugworks 3D Printing - Print Canceled",
-                                    body=f"Your print on {printer_name} was canceled because: {reason}. Please contact Slugworks staff if you have any questions.",
-                                    cc=EMAIL_CC,
-                                    reply_to=EMAIL_REPLY_TO,
-                                )
-                            # TODO: log cancelation
-                            logger.warning("cancel! - " + reason)
-                            status_data.loc[i, "Status"] = printer_statuses[
-                                PRINTER_CANCEL_PENDING
-                            ]
-
-                        if (
-                            status_data.loc[i, "Status"]
-                            == printer_statuses[PRINTER_AVAILABLE]
-                        ):
-                            # if printer is printing but status was set to available
-                            # a print must have been started without a booking
-                            print_without_booking.append(printer_name)
-                            print_without_booking_data[printer_name] = (
-                                i,
-                                datetime.datetime.fromtimestamp(
-                                    printer.start_time * 60
-                                ),
-                            )
-                        elif (
-                            status_data.loc[i, "Status"]
-                            == printer_statuses[PRINTER_BOOKED]
-                        ):
-                            # if printer is printing but status was set to booked
-                            # a print must have been started with a booking (but may not have been started by the user who booked it)
-                            print_with_booking.append(printer_name)
-                            print_with_booking_data[printer_name] = (
-                                i,
-                                user,
-                                currently_booked_or_printing_rows[user],
-                                datetime.datetime.fromtimestamp(
-                                    printer.start_time * 60
-                                ),
-                            )
-
-                        # update printer status in status sheet
-                        update_printer_status(
-                            i,  # printer number
-                            (
-                                PRINTER_PRINTING
-                                if status_data.loc[i, "Status"]
-                                != printer_statuses[PRINTER_CANCEL_PENDING]
-                                else None
-                            ),  # set status to printing, unless it is cancel pending (in which case leave it)
-                            None,  # do not change the user
-                            datetime.datetime.fromtimestamp(
-                                printer.start_time * 60
-                            ),  # set start time to the time the print started
-                            timestamp
-                            + datetime.timedelta(
-                                minutes=printer.time_remaining
-                            ),  # set end time to the time the print will finish
-                        )
-                    elif (
-                        status_data.loc[i, "Status"]
-                        == printer_statuses[PRINTER_PRINTING]
-                    ):
-                        # if printer just finished printing
-                        # get user who booked/started the print
-                        user = status_data.loc[i, "Current User"].strip()
-                        # if user is currently printing
-                        if user and user in currently_booked_or_printing:
-                            # add user to list of completed prints
-                            complete_prints.append(user)
-                        # set printer status to available
-                        update_printer_status(i, PRINTER_AVAILABLE, "", "", "")
-                    elif (
-                        status_data.loc[i, "Status"] not in printer_statuses
-                        or status_data.loc[i, "Status"]
-                        == printer_statuses[PRINTER_CANCEL_PENDING]
-                    ):
-                        # if printer is not printing but no valid status is recorded, or if print was canceled
-                        # set printer status to available
-                        update_printer_status(i, PRINTER_AVAILABLE, "", "", "")
-
-                    # if printer is available and someone is waiting for a printer
-                    if (
-                        status_data.loc[i, "Status"]
-                        == printer_statuses[PRINTER_AVAILABLE]
-                        and waiting_for_printer
-                    ):
-                        # get start time for booking
-                        start_time = timestamp
-
-                        if start_time.weekday() > 4:
-                            # if the start time is on a weekend, set start time to 12pm the next Monday
-                            start_time = datetime.datetime.combine(
-                                timestamp.date(), datetime.datetime.min.time()
-                            ) + datetime.timedelta(
-                                days=(7 - start_time.weekday()), hours=12
-                            )
-                        elif start_time.hour >= 21:
-                            # if the start time is after 9pm, set start time to 12pm the next day
-                            start_time = datetime.datetime.combine(
-                                timestamp.date(), datetime.datetime.min.time()
-                            ) + datetime.timedelta(days=1, hours=12)
-                        elif start_time.hour < 12:
-                            # if the start time is before 12pm, set start time to 12pm
-                            start_time = datetime.datetime.combine(
-                                timestamp.date(), datetime.datetime.min.time()
-                            ) + datetime.timedelta(hours=12)
-
-                        # get end time for booking
-                        end_time = start_time + datetime.timedelta(hours=BOOKING_TIME)
-                        if end_time.hour >= 21 or end_time.hour < 12:
-                            # if the end time is after 9pm
-                            # 3 hours + 12 hours for next day from 9pm to 12pm
-                            end_time = end_time + datetime.timedelta(hours=3 + 12)
-                            if end_time.weekday() > 4:
-                                # if the end time is on a weekend, set end time to the same time the next Monday
-                                end_time += datetime.timedelta(
-                                    days=(7 - end_time.weekday())
-                                )
-
-                        # get first user waiting for a printer
-                        user = waiting_for_printer.pop(0)
-                        # get row number of user in booking_data
-                        row = waiting_for_printer_rows.pop(user)
-                        # update printer status in status sheet
-                        update_printer_status(
-                            i,  # printer number
-                            PRINTER_BOOKED,  # set status to booked
-                            user,  # set user to the user who booked the printer
-                            start_time,
-                            end_time,
-                        )
-                        # add user to list of currently booked or printing users
-                        currently_booked_or_printing.append(user)
-                        currently_booked_or_printing_rows[user] = row
-                        # update booking status in booking sheet
-                        booking_data.loc[row, "Status"] = booking_statuses[USER_BOOKED]
-                        today = end_time.date() == timestamp.date()
-                        gmail_send_message(
-                            recipient=user + "@ucsc.edu",
-                            sender=EMAIL_SENDER,
-                            subject="Slugworks 3D Printing - Booked",
-                            body=f"It's your turn to print on {printer_name}! Start your print before {end_time.strftime('%I:%M %p')} on {end_time.strftime('%m/%d')}.",
-                            cc=EMAIL_CC,
-                            reply_to=EMAIL_REPLY_TO,
-                        )
-                        logger.warning("booked!")
-                    elif status_data.loc[i, "Status"] == printer_statuses[
-                        PRINTER_BOOKED
-                    ] and timestamp >= datetime.datetime.strptime(
-                        status_data.loc[i, "End Time"].strip() + ":00",
-                        "%Y-%m-%d %H:%M:%S",
-                    ):
-                        # if printer is booked but booking time has expired
-                        # get user who booked the printer
-                        user = status_data.loc[i, "Current User"]
-                        row = currently_booked_or_printing_rows.pop(user)
-                        # update printer status in status sheet to available
-                        update_printer_status(i, PRINTER_AVAILABLE, "", "", "")
-                        # update booking status in booking sheet to did not start print
-                        booking_data.loc[row, "Status"] = booking_statuses[
-                            USER_NO_START
-                        ]
-
-                for i in starting_data.index.values[::-1]:
-                    # iterate through starting data in reverse order
-
-                    if datetime.datetime.strptime(
-                        starting_data.loc[i, "Timestamp"], "%m/%d/%Y %H:%M:%S"
-                    ) <= timestamp - datetime.timedelta(minutes=TIME_TO_START):
-                        # if the starting data is more than 10 minutes old, stop iterating
-                        break
-
-                    if starting_data.loc[i, "Handled"] == "TRUE":
-                        # if the starting data has already been handled, skip
-                        continue
-
-                    # get cruzid, printer name, and weight (grams) from starting data
-                    cruzid = starting_data.loc[i, "Email Address"].split("@")[0].strip()
-                    printer = starting_data.loc[i, "Printer"]
-                    weight = starting_data.loc[i, "Weight"]
-
-                    if printer in print_without_booking and sheet.is_staff(
-                        cruzid=cruzid
-                    ):
-                        # if printer has started a print without a booking and the user is staff
-                        printer_num, start_time = print_without_booking_data[printer]
-                        # update printer status in status sheet to add the user
-                        update_printer_status(printer_num, None, cruzid, None, None)
-                        # remove printer from list of printers that have started prints without a booking
-                        print_without_booking.remove(printer)
-                        print_without_booking_data.pop(printer)
-                        # update starting data to show that it has been handled
-                        starting_data.loc[i, "Handled"] = "TRUE"
-                    elif printer in print_with_booking:
-                        # if printer has started a print with a booking
-                        # get the print data
-                        printer_num, user, row, start_time = print_with_booking_data[
-                            printer
-                        ]
-                        if cruzid == user.strip():
-                            # if the user who booked the printer is the one from the start form
-                            # update booking status in booking sheet to currently printing
-                            booking_data.loc[row, "Status"] = booking_statuses[
-                                USER_PRINTING
-                            ]
-                            # remove printer from list of printers that have started prints with a booking
-                            print_with_booking.remove(printer)
-                            print_with_booking_data.pop(printer)
-                            # set starting data to handled
-                            starting_data.loc[i, "Handled"] = "TRUE"
-
-                            if not print_weight(cruzid, weight):
-                                # if the user has exceeded their weight limit
-                                printer_over_limit.append(printer_num)
-                            # TODO: log print
-                        elif sheet.is_staff(cruzid=cruzid):
-                            # if the user who started the print is staff
-                            # update booking status in booking sheet to supervised printing
-                            booking_data.loc[row, "Status"] = booking_statuses[
-                                USER_SUPERVISED
-                            ]
-                            # remove printer from list of printers that have started prints with a booking
-                            print_with_booking.remove(printer)
-                            print_with_booking_data.pop(printer)
-                            # set starting data to handled
-                            starting_data.loc[i, "Handled"] = "TRUE"
-
-                            if not print_weight(cruzid, weight):
-                                # if the user has exceeded their weight limit
-                                printer_over_limit.append(printer_num)
-                            # TODO: log print
-
-                # boolean to check if the first active index has been found
-                found_first_active_index = False
-
-                for i, row in booking_data.iloc[booking_index:].iterrows():
-                    # iterate through booking data starting from the first active index
-                    # get cruzid from email address
-                    cruzid = row["Email Address"].split("@")[0]
-                    if row["Status"] in ["", booking_statuses[USER_WAITING]]:
-                        # if the booking status is blank or waiting for printer
-                        if sheet.is_staff(cruzid=cruzid) or sheet.get_access(
-                            "3D Printing", cruzid=cruzid
-                        ):
-                            # if the user is staff or has access to 3D printing
-                            # set the user to waiting for printer
-                            row["Status"] = booking_statuses[USER_WAITING]
-                            if (
-                                cruzid not in currently_booked_or_printing
-                                and cruzid not in waiting_for_printer
-                            ):
-                                # if the user is not currently booked or printing and not already waiting for a printer
-                                # add the user to the list of users waiting for a printer & save the row number
-                                waiting_for_printer.append(cruzid)
-                                waiting_for_printer_rows[cruzid] = i
-                                gmail_send_message(
-                                    recipient=cruzid + "@ucsc.edu",
-                                    sender=EMAIL_SENDER,
-                                    subject="Slugworks 3D Printing - Waiting",
-                                    body="You are now waiting for a 3D printer at Slugworks. You will receive an email when a printer is booked for you to use.",
-                                    cc=EMAIL_CC,
-                                    reply_to=EMAIL_REPLY_TO,
-                                )
-                                # TODO: log addition to queue
-                                logger.warning("waiting!")
-                        else:
-                            # if the user is not staff and does not have access to 3D printing
-                            # set the user to not certified
-                            row["Status"] = booking_statuses[USER_NOT_CERTIFIED]
-                    elif (
-                        row["Status"]
-                        in [
-                            booking_statuses[USER_PRINTING],
-                            booking_statuses[USER_SUPERVISED],
-                        ]
-                        and cruzid in complete_prints
-                        and i == currently_booked_or_printing_rows[cruzid]
-                    ):
-                        # if the user is currently printing and has completed their print (and this is their booking row)
-                        # set the user to print done
-                        row["Status"] = booking_statuses[USER_DONE]
-                        # remove the user from the list of users who have completed their prints and the list of currently booked or printing users
-                        complete_prints.remove(cruzid)
-                        currently_booked_or_printing.remove(cruzid)
-                        currently_booked_or_printing_rows.pop(cruzid)
-
-                    if (
-                        not found_first_active_index
-                        and row["Status"]
-                        in booking_statuses[USER_WAITING : (USER_SUPERVISED + 1)]
-                    ):
-                        # if the first active index has not been found and the booking status is one of the active statuses
-                        # set the first active index to the current index
-                        found_first_active_index = True
-                        booking_index = i
-
-                # write data to sheets
-                write_booking_sheet()
-                write_starting_sheet()
-                write_status_sheet()
-                write_limits_sheet()
-
-                while datetime.datetime.now() < timestamp + datetime.timedelta(
-                    seconds=10
-                ):
-                    time.sleep(1)
+if __name__ == "__main__":
+    # Set the working directory to the directory of this file
+    os.chdir(path)
+    log_listener = setup_logging()
+    load_printer_data()
+    connect()
+    state_store = StateStore(STATE_FILE)
+    metrics.serve(METRICS_PORT)
+
+    try:
+        # send emails from a background thread, so the scheduler never waits on the Gmail API
+        start_outbox()
+
+        start()
 
-            except Exception as e:
-                if type(e) == KeyboardInterrupt:
-                    raise e
-                logger.error(f"Error: {e}")
-                time.sleep(60)
+        # printer state changes are handled while waiting for the next job
+        create_scheduler(wait=handle_printer_events).run()
 
     except KeyboardInterrupt:
         print("Exiting...")
+        stop_outbox()
+        state_store.close()
         for _, printer in printers:
             if printer.state != PrinterState.QUIT:
                 printer.quit()
+        # write the logs that are still queued
+        log_listener.stop()
         exit(0)
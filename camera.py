@@ -0,0 +1,202 @@
+import logging
+import os
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+IDLE_TIMEOUT = 30  # seconds without viewers before the RTSP session is closed
+RECONNECT_DELAY = 5  # seconds to wait before reopening a stream that failed
+FRAME_TIMEOUT = 10  # seconds a viewer waits for a new frame before giving up
+JPEG_QUALITY = 80  # default encode quality, 0-100
+
+# a captured frame - the decoded image, its JPEG encoding, and the JPEG as a multipart part
+# (both None if no viewer needed JPEGs when it was captured)
+Frame = namedtuple("Frame", ["image", "jpeg", "part"])
+
+# frames from every camera are encoded on this pool, so several cameras use several cores
+# (cv2 releases the GIL while encoding)
+encoder = ThreadPoolExecutor(max_workers=os.cpu_count())
+
+
+class Camera:
+    """A printer camera shared by every dashboard viewer.
+
+    A background thread holds the only RTSP session to the camera. Each captured frame is
+    encoded once, at the camera's quality and width, and the latest Frame is shared by
+    reference between any number of viewers. Frames are only encoded while a viewer needs
+    JPEGs - viewers that only read the image (like the mosaic) get it as it was decoded.
+    The session is opened when the first viewer subscribes and closed once there have been
+    no viewers for idle_timeout seconds.
+    """
+
+    def __init__(
+        self, url, quality=JPEG_QUALITY, width=None, idle_timeout=IDLE_TIMEOUT
+    ):
+        self.url = url
+        self.quality = quality
+        self.width = width  # frames wider than this are scaled down before encoding
+        self.idle_timeout = idle_timeout
+
+        self.frame = None  # latest Frame
+        self.frame_id = 0  # incremented for every new frame
+        # incremented whenever a session opens or closes, so frames from a closed session are dropped
+        self.session = 0
+        self.session_start_id = 0  # frame_id when the current session opened
+        self.encoding = False  # whether a frame is waiting on the encoder
+        self.viewers = 0
+        self.jpeg_viewers = 0  # viewers that need frames encoded as JPEG
+        self.last_viewed = 0.0
+
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def subscribe(self, jpeg=True):
+        """Register a viewer, opening the RTSP session if it is not already open.
+        jpeg: whether the viewer needs the frames encoded, rather than only their images
+        """
+        with self.condition:
+            self.viewers += 1
+            self.jpeg_viewers += jpeg
+            self.last_viewed = time.monotonic()
+            if self.thread is None:
+                # viewers wait for the new session's first frame, not one from an old session
+                self.session += 1
+                self.session_start_id = self.frame_id
+                self.frame = None
+                self.thread = threading.Thread(
+                    target=self.capture, args=(self.session,), daemon=True
+                )
+                self.thread.start()
+
+    def unsubscribe(self, jpeg=True):
+        """Unregister a viewer, with the jpeg it subscribed with. The session stays open for
+        idle_timeout seconds in case another viewer subscribes."""
+        with self.condition:
+            self.viewers -= 1
+            self.jpeg_viewers -= jpeg
+            self.last_viewed = time.monotonic()
+
+    def get_frame(self, last_id=0, timeout=FRAME_TIMEOUT, jpeg=True):
+        """Wait for a frame newer than last_id, from the current session - and encoded, if jpeg.
+        Returns: (frame id, Frame), or (last_id, None) if no new frame arrived in time
+        """
+        with self.condition:
+            if not self.condition.wait_for(
+                lambda: self.frame_id > max(last_id, self.session_start_id)
+                and (not jpeg or self.frame.jpeg is not None),
+                timeout=timeout,
+            ):
+                return last_id, None
+            return self.frame_id, self.frame
+
+    def latest(self):
+        """Get the latest Frame without waiting, or None if there is none yet."""
+        with self.condition:
+            return self.frame
+
+    def idle(self):
+        # whether the session can be closed - call with the condition held
+        return (
+            self.viewers <= 0
+            and time.monotonic() - self.last_viewed > self.idle_timeout
+        )
+
+    def capture(self, session):
+        # read frames into the shared buffer until there have been no viewers for idle_timeout
+        cap = None
+        try:
+            while True:
+                with self.condition:
+                    if self.idle():
+                        # clear the thread while holding the lock, so a new viewer starts a new one
+                        self.thread = None
+                        self.frame = None
+                        # frames still being encoded belong to the closed session
+                        self.session += 1
+                        return
+
+                if cap is None:
+                    cap = cv2.VideoCapture(self.url)
+
+                success, frame = cap.read()
+                if not success:
+                    logging.warning(f"Could not read from {self.url}, reconnecting")
+                    cap.release()
+                    cap = None
+                    time.sleep(RECONNECT_DELAY)
+                    continue
+
+                with self.condition:
+                    if not self.jpeg_viewers:
+                        # nobody needs JPEGs, so share the decoded image as it is
+                        self.publish(Frame(frame, None, None))
+                        continue
+                    if self.encoding:
+                        # drop this frame rather than fall behind the camera
+                        continue
+                    self.encoding = True
+                encoder.submit(self.encode, frame, session)
+        finally:
+            if cap is not None:
+                cap.release()
+
+    def encode(self, image, session):
+        # encode a captured frame once and publish it to every viewer, unless its session closed
+        try:
+            if self.width and image.shape[1] > self.width:
+                height = image.shape[0] * self.width // image.shape[1]
+                image = cv2.resize(
+                    image, (self.width, height), interpolation=cv2.INTER_AREA
+                )
+
+            success, buffer = cv2.imencode(
+                ".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, self.quality]
+            )
+            if not success:
+                return
+            jpeg = buffer.tobytes()
+            part = b"--frame\r\n" b"Content-Type: image/jpeg\r\n\r\n" + jpeg + b"\r\n"
+
+            with self.condition:
+                if session != self.session:
+                    return
+                self.publish(Frame(image, jpeg, part))
+        finally:
+            with self.condition:
+                self.encoding = False
+
+    def publish(self, frame):
+        # make a frame the latest one and wake the viewers - call with the condition held
+        self.frame = frame
+        self.frame_id += 1
+        self.condition.notify_all()
+
+
+def resize(image, width, height):
+    """Scale an image to width x height by nearest neighbour, using NumPy indexing for the
+    whole image at once - plenty for thumbnails, and much cheaper than interpolating."""
+    rows = np.arange(height) * image.shape[0] // height
+    columns = np.arange(width) * image.shape[1] // width
+    return image[rows[:, None], columns]
+
+
+def mosaic(images, columns, tile_width, tile_height):
+    """Tile images into a grid with the given number of columns, left to right and top to
+    bottom. Missing images (None) are left black."""
+    rows = max(-(-len(images) // columns), 1)
+    grid = np.zeros((rows * tile_height, columns * tile_width, 3), dtype=np.uint8)
+
+    for i, image in enumerate(images):
+        if image is None:
+            continue
+        row, column = divmod(i, columns)
+        grid[
+            row * tile_height : (row + 1) * tile_height,
+            column * tile_width : (column + 1) * tile_width,
+        ] = resize(image, tile_width, tile_height)
+
+    return grid
@@ -1,11 +1,24 @@
 import json
+import math
 import sys
+import threading
+import time
 
 import cv2
-from flask import Flask, Response, render_template
+
+from flask import Flask, Response, render_template, request
+
+from camera import FRAME_TIMEOUT, JPEG_QUALITY, Camera, mosaic
 
 # https://github.com/akmamun/multiple-camera-stream
 
+TARGET_FPS = 10  # default frame rate of live streams
+MIN_FPS = 0.1
+
+MOSAIC_FPS = 1  # frame rate of the live mosaic
+TILE_WIDTH = 320
+TILE_HEIGHT = 180
+
 
 app = Flask(__name__)
 
@@ -15,55 +28,159 @@ printer_data = json.load(open("printers.json"))
 
 for name in printer_data:
     p = printer_data[name]
-    if (
-        "hostname" not in p
-        or "access_code" not in p
-        or "serial_number" not in p
-    ):
+    if "hostname" not in p or "access_code" not in p or "serial_number" not in p:
         print(
             f"Error: printer config for {name} missing hostname, access_code, or serial_number"
         )
         sys.exit(1)
-    cameras.append(f"rtsps://bblp:{p["access_code"]}@{p["hostname"]}/streaming/live/1")
-
+    # one shared capture per camera, however many viewers there are
+    # encode quality and width can be set per printer with camera_quality and camera_width
+    cameras.append(
+        Camera(
+            f"rtsps://bblp:{p['access_code']}@{p['hostname']}/streaming/live/1",
+            quality=p.get("camera_quality", JPEG_QUALITY),
+            width=p.get("camera_width"),
+        )
+    )
 
 
 def find_camera(id):
     return cameras[int(id)]
 
 
-def gen_frames(camera_id):
+def snapshot(camera_id):
+    """Get the latest frame from a camera as a JPEG, or None if the camera sent no frame."""
+    cam = find_camera(camera_id)
+    cam.subscribe()
+
+    try:
+        _, frame = cam.get_frame()  # read the camera frame
+        return frame.jpeg if frame is not None else None
+    finally:
+        cam.unsubscribe()
+
 
+def gen_frames(camera_id, fps=TARGET_FPS):
+    """Stream frames from a camera as multipart JPEG parts, at most fps per second.
+    Frames captured while waiting are dropped rather than buffered, so the stream stays live.
+    The viewer is unsubscribed when the client disconnects and the generator is closed.
+    """
     cam = find_camera(camera_id)
-    cap = cv2.VideoCapture(cam)
-
-    while True:
-        success, frame = cap.read()  # read the camera frame
-        if success:
-            _, buffer = cv2.imencode(".jpg", frame)
-            frame = buffer.tobytes()
-            out = (
-                b"--frame\r\n" b"Content-Type: image/jpeg\r\n\r\n" + frame + b"\r\n"
-            )  # concat frame one by one and show result
-# if LIVESTREAM:
-            # yield out
-# else:
-            return out
-        else:
-            break
+    cam.subscribe()
+
+    try:
+        frame_id = 0
+        while True:
+            started = time.monotonic()
+            # always send the newest frame, skipping any captured since the last one was sent
+            frame_id, frame = cam.get_frame(frame_id)
+            if frame is None:
+                # the camera has stopped sending frames
+                break
+            # frames are already encoded, once for every viewer
+            yield frame.part  # concat frame one by one and show result
+            time.sleep(max(0, 1 / fps - (time.monotonic() - started)))
+    finally:
+        cam.unsubscribe()
 
 
 @app.route("/video_feed/<string:id>/", methods=["GET"])
 def video_feed(id):
-    """Video streaming route. Put this in the src attribute of an img tag."""
-    return Response(
-        gen_frames(id), mimetype="multipart/x-mixed-replace; boundary=frame"
-    )
+    """Video streaming route. Put this in the src attribute of an img tag.
+    Serves a single snapshot, or a live stream with ?live=1 (at ?fps= frames per second).
+    """
+    if request.args.get("live", "0") not in ["", "0", "false"]:
+        fps = max(request.args.get("fps", TARGET_FPS, type=float), MIN_FPS)
+        return Response(
+            gen_frames(id, fps), mimetype="multipart/x-mixed-replace; boundary=frame"
+        )
+
+    frame = snapshot(id)
+    if frame is None:
+        return Response("Camera unavailable", status=503)
+    return Response(frame, mimetype="image/jpeg")
+
+
+def mosaic_columns():
+    # as close to a square grid as possible
+    return max(math.ceil(math.sqrt(len(cameras))), 1)
+
+
+# the latest mosaic is shared between viewers, and only rebuilt once it is 1 / MOSAIC_FPS old
+mosaic_frame = None
+mosaic_time = 0.0
+mosaic_lock = threading.Lock()
+
+
+def get_mosaic(fps=MOSAIC_FPS):
+    """Get a JPEG of the latest frame from every camera, downscaled and tiled into a grid.
+    Callers must be subscribed to every camera - only their images are used, so jpeg=False.
+    """
+    global mosaic_frame, mosaic_time
+    with mosaic_lock:
+        if mosaic_frame is None or time.monotonic() - mosaic_time >= 1 / fps:
+            frames = [cam.latest() for cam in cameras]
+            grid = mosaic(
+                [f.image if f is not None else None for f in frames],
+                mosaic_columns(),
+                TILE_WIDTH,
+                TILE_HEIGHT,
+            )
+            _, buffer = cv2.imencode(
+                ".jpg", grid, [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY]
+            )
+            mosaic_frame = buffer.tobytes()
+            mosaic_time = time.monotonic()
+        return mosaic_frame
+
+
+def gen_mosaic(fps=MOSAIC_FPS):
+    """Stream the mosaic of every camera as multipart JPEG parts, fps times per second."""
+    for cam in cameras:
+        cam.subscribe(jpeg=False)
+
+    try:
+        while True:
+            started = time.monotonic()
+            yield (
+                b"--frame\r\n"
+                b"Content-Type: image/jpeg\r\n\r\n" + get_mosaic(fps) + b"\r\n"
+            )
+            time.sleep(max(0, 1 / fps - (time.monotonic() - started)))
+    finally:
+        for cam in cameras:
+            cam.unsubscribe(jpeg=False)
+
+
+@app.route("/mosaic/", methods=["GET"])
+def mosaic_feed():
+    """Overview route - one downscaled tile per camera in a single image.
+    Serves a single snapshot, or a live stream with ?live=1 (at ?fps= frames per second).
+    """
+    if request.args.get("live", "0") not in ["", "0", "false"]:
+        fps = max(request.args.get("fps", MOSAIC_FPS, type=float), MIN_FPS)
+        return Response(
+            gen_mosaic(fps), mimetype="multipart/x-mixed-replace; boundary=frame"
+        )
+
+    for cam in cameras:
+        cam.subscribe(jpeg=False)
+    try:
+        # give every camera a chance to send its first frame, all within one timeout
+        deadline = time.monotonic() + FRAME_TIMEOUT
+        for cam in cameras:
+            cam.get_frame(timeout=max(deadline - time.monotonic(), 0), jpeg=False)
+        return Response(get_mosaic(), mimetype="image/jpeg")
+    finally:
+        for cam in cameras:
+            cam.unsubscribe(jpeg=False)
 
 
 @app.route("/", methods=["GET"])
 def index():
-    return render_template("index.html", camera_count=len(cameras))
+    return render_template(
+        "index.html", camera_count=len(cameras), columns=mosaic_columns()
+    )
 
 
 if __name__ == "__main__":
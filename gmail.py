@@ -1,8 +1,13 @@
 from __future__ import print_function
 
 import base64
+import json
 import logging
 import os
+import queue
+import threading
+import time
+import uuid
 from email.message import EmailMessage
 
 from google.auth.transport.requests import Request
@@ -11,21 +16,49 @@ from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 
+import metrics
+
 # If modifying these scopes, delete the file token.json.
 SCOPES = ["https://www.googleapis.com/auth/gmail.send"]
 
+path = os.path.dirname(os.path.abspath(__file__))
 
-def gmail_send_message(recipient, sender, subject, body, cc, reply_to):
-    """Create and send an email message
-    Print the returned  message id
-    Returns: Message object, including message id
+# messages waiting to be sent are spooled here, so they survive a restart
+OUTBOX_PATH = path + "/outbox"
+MAX_ATTEMPTS = 5
+RETRY_DELAY = 5  # seconds, doubled after every failed attempt
+BATCH_SIZE = 100  # most requests the API allows in one batch request
+
+service = None
+service_lock = threading.Lock()  # the API client's http object is not thread safe
+
+outbox = queue.Queue()
+outbox_thread = None
+
+emails_queued = metrics.Counter(
+    "emails_queued_total", "Email messages queued, by subject", ["subject"]
+)
+emails_sent = metrics.Counter("emails_sent_total", "Email messages sent")
+email_failures = metrics.Counter(
+    "email_failures_total", "Email messages given up on after MAX_ATTEMPTS"
+)
+gmail_api_seconds = metrics.Histogram(
+    "gmail_api_seconds", "Latency of Gmail API batch requests"
+)
+
+
+def get_service():
+    """Get the Gmail API service, loading the credentials and building it on first use.
 
     Load pre-authorized user credentials from the environment.
     TODO(developer) - See https://developers.google.com/identity
     for guides on implementing OAuth2 for the application.
     """
+    global service
+    if service is not None:
+        return service
+
     creds = None
-    path = os.path.dirname(os.path.abspath(__file__))
 
     # The file token.json stores the user's access and refresh tokens, and is
     # created automatically when the authorization flow completes for the first
@@ -48,28 +81,51 @@ def gmail_send_message(recipient, sender, subject, body, cc, reply_to):
         with open(path + "/gmail_token.json", "w") as token:
             token.write(creds.to_json())
 
+    # the service refreshes the credentials itself when they expire
+    service = build("gmail", "v1", credentials=creds)
+    return service
+
+
+def create_message(recipient, sender, subject, body, cc, reply_to):
+    """Create an email message
+    Returns: the message encoded for the Gmail API
+    """
+    message = EmailMessage()
+
+    message.set_content(body)
+
+    message["To"] = recipient
+    message["From"] = sender
+    if cc:
+        message["CC"] = cc
+    if reply_to:
+        message["Reply-To"] = reply_to
+    message["Subject"] = subject
+
+    # encoded message
+    encoded_message = base64.urlsafe_b64encode(message.as_bytes()).decode()
+
+    return {"raw": encoded_message}
+
+
+def gmail_send_message(recipient, sender, subject, body, cc, reply_to):
+    """Create and send an email message
+    Print the returned  message id
+    Returns: Message object, including message id
+    """
     try:
-        service = build("gmail", "v1", credentials=creds)
-        message = EmailMessage()
-
-        message.set_content(body)
-
-        message["To"] = recipient
-        message["From"] = sender
-        if cc:
-            message["CC"] = cc
-        if reply_to:
-            message["Reply-To"] = reply_to
-        message["Subject"] = subject
-
-        # encoded message
-        encoded_message = base64.urlsafe_b64encode(message.as_bytes()).decode()
-
-        create_message = {"raw": encoded_message}
-        # pylint: disable=E1101
-        send_message = (
-            service.users().messages().send(userId="me", body=create_message).execute()
-        )
+        with service_lock:
+            # pylint: disable=E1101
+            send_message = (
+                get_service()
+                .users()
+                .messages()
+                .send(
+                    userId="me",
+                    body=create_message(recipient, sender, subject, body, cc, reply_to),
+                )
+                .execute()
+            )
         logging.info(f'Message Id: {send_message["id"]}')
     except HttpError as error:
         logging.error(f"An error occurred: {error}")
@@ -77,6 +133,179 @@ def gmail_send_message(recipient, sender, subject, body, cc, reply_to):
     return send_message
 
 
+def spool_message(message):
+    # write a queued message to the outbox folder, replacing any earlier copy of it
+    os.makedirs(OUTBOX_PATH, exist_ok=True)
+    with open(f"{OUTBOX_PATH}/{message['id']}.json", "w") as f:
+        json.dump(message, f)
+
+
+def gmail_queue_message(recipient, sender, subject, body, cc, reply_to):
+    """Add an email message to the outbox, to be sent by the outbox thread.
+    The message is spooled to disk first, so it is still sent after a restart.
+    Returns: the id of the queued message
+    """
+    message = {
+        # ids sort in the order messages were queued
+        "id": f"{time.time_ns()}-{uuid.uuid4().hex[:8]}",
+        "recipient": recipient,
+        "sender": sender,
+        "subject": subject,
+        "body": body,
+        "cc": cc,
+        "reply_to": reply_to,
+        "attempts": 0,
+    }
+    spool_message(message)
+    emails_queued.inc(subject=subject)
+    if outbox_thread is not None:
+        outbox.put(message)
+    # otherwise start_outbox() queues it from the spool
+    return message["id"]
+
+
+def gmail_send_messages(messages):
+    """Send many email messages using batch requests, with up to BATCH_SIZE messages per request
+    messages: list of dicts with recipient, sender, subject, body, cc and reply_to
+    Returns: for each message, its message id if it was sent, otherwise the exception
+    """
+    results = [None] * len(messages)
+
+    def callback(request_id, response, exception):
+        results[int(request_id)] = exception if exception else response["id"]
+
+    with service_lock:
+        gmail = get_service()
+        for start in range(0, len(messages), BATCH_SIZE):
+            batch = gmail.new_batch_http_request(callback=callback)
+            for i in range(start, min(start + BATCH_SIZE, len(messages))):
+                m = messages[i]
+                # pylint: disable=E1101
+                batch.add(
+                    gmail.users()
+                    .messages()
+                    .send(
+                        userId="me",
+                        body=create_message(
+                            m["recipient"],
+                            m["sender"],
+                            m["subject"],
+                            m["body"],
+                            m["cc"],
+                            m["reply_to"],
+                        ),
+                    ),
+                    request_id=str(i),
+                )
+            try:
+                with gmail_api_seconds.time():
+                    batch.execute()
+            except Exception as error:
+                # the batch request itself failed (an HTTP error, a timeout, a failed token
+                # refresh...), so none of its messages were sent
+                for i in range(start, min(start + BATCH_SIZE, len(messages))):
+                    results[i] = error
+
+    for m, result in zip(messages, results):
+        if isinstance(result, Exception):
+            logging.error(f"An error occurred sending to {m['recipient']}: {result}")
+        else:
+            logging.info(f"Message Id: {result}")
+    return results
+
+
+def handle_send_result(message, result):
+    # remove a sent message from the outbox, or retry it later with backoff if sending it failed
+    if not isinstance(result, Exception):
+        os.remove(f"{OUTBOX_PATH}/{message['id']}.json")
+        emails_sent.inc()
+        return
+
+    message["attempts"] += 1
+    if message["attempts"] >= MAX_ATTEMPTS:
+        # leave the message in the outbox folder, but stop trying to send it
+        email_failures.inc()
+        logging.error(
+            f"Giving up on message to {message['recipient']} after {message['attempts']} attempts: {result}"
+        )
+        os.rename(
+            f"{OUTBOX_PATH}/{message['id']}.json",
+            f"{OUTBOX_PATH}/{message['id']}.failed",
+        )
+        return
+
+    delay = RETRY_DELAY * 2 ** (message["attempts"] - 1)
+    logging.warning(
+        f"Could not send message to {message['recipient']}, retrying in {delay}s: {result}"
+    )
+    spool_message(message)
+    # requeue after the delay without holding up the rest of the outbox
+    timer = threading.Timer(delay, outbox.put, args=[message])
+    timer.daemon = True
+    timer.start()
+
+
+def outbox_worker():
+    while True:
+        messages = [outbox.get()]
+        # send everything else that is already queued in the same batch request
+        while len(messages) < BATCH_SIZE:
+            try:
+                messages.append(outbox.get_nowait())
+            except queue.Empty:
+                break
+
+        # stop_outbox() queues None
+        stopping = None in messages
+        messages = [m for m in messages if m is not None]
+
+        if messages:
+            try:
+                results = gmail_send_messages(messages)
+            except Exception as e:
+                # e.g. the credentials could not be refreshed - retry every message with backoff
+                results = [e] * len(messages)
+            for message, result in zip(messages, results):
+                try:
+                    handle_send_result(message, result)
+                except Exception as e:
+                    # keep the outbox running - the message stays spooled and is retried on the next start
+                    logging.error(
+                        f"Error handling message to {message['recipient']}: {e}"
+                    )
+
+        if stopping:
+            return
+
+
+def start_outbox():
+    """Start the outbox thread, first queueing any messages spooled by a previous run."""
+    global outbox_thread
+    if outbox_thread is not None:
+        return
+
+    os.makedirs(OUTBOX_PATH, exist_ok=True)
+
+    for filename in sorted(os.listdir(OUTBOX_PATH)):
+        if filename.endswith(".json"):
+            with open(f"{OUTBOX_PATH}/{filename}") as f:
+                outbox.put(json.load(f))
+
+    outbox_thread = threading.Thread(target=outbox_worker, daemon=True)
+    outbox_thread.start()
+
+
+def stop_outbox(timeout=10):
+    """Stop the outbox thread after the messages already queued have been sent, waiting at most
+    timeout seconds. Messages not sent by then stay spooled for the next start."""
+    global outbox_thread
+    if outbox_thread is None:
+        return
+    outbox.put(None)
+    outbox_thread.join(timeout)
+    outbox_thread = None
+
+
 if __name__ == "__main__":
     body = """Hi!
     
@@ -90,5 +319,5 @@ Ishan"""
         "Autoslug Discord Invite",
         body,
         "",
-        ""
+        "",
     )
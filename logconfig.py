@@ -0,0 +1,88 @@
+import json
+import logging
+import logging.handlers
+import os
+import queue
+
+LOG_MAX_BYTES = 10 * 2**20  # debug and JSON lines logs are rotated at this size
+LOG_BACKUPS = 5  # rotated debug and JSON lines logs kept
+INFO_LOG_DAYS = 14  # the info log is rotated at midnight, and this many days are kept
+
+FORMAT = "%(asctime)s - %(name)s - %(levelname)s: %(message)s"
+
+
+class JSONLinesFormatter(logging.Formatter):
+    """Formats each record as one line of JSON, for machine parsing."""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """Queues records as they are, without formatting them first.
+
+    QueueHandler formats records before queueing them, so they can be pickled. The queue here
+    stays in this process, so formatting (and merging the %-style arguments into the message) is
+    left to the listener's thread. Arguments must not be changed after they are logged.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+def setup(logger, path, json_lines=False):
+    """Send the logger's records through a queue to a background thread that writes them:
+    everything to a debug log rotated by size, info and above to an info log rotated daily,
+    warnings and above to the console, and optionally everything to a JSON lines log.
+    Returns the QueueListener, which should be stopped on exit to write what is queued.
+    """
+    # Create a new directory for logs if it doesn't exist
+    os.makedirs(path, exist_ok=True)
+
+    # create file handler which logs debug messages (and above - everything)
+    fh_debug = logging.handlers.RotatingFileHandler(
+        f"{path}/debug.log", maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS
+    )
+    fh_debug.setLevel(logging.DEBUG)
+
+    # create file handler which logs only info messages (and above)
+    fh_info = logging.handlers.TimedRotatingFileHandler(
+        f"{path}/info.log", when="midnight", backupCount=INFO_LOG_DAYS
+    )
+    fh_info.setLevel(logging.INFO)
+
+    # create console handler which only logs warnings (and above)
+    ch = logging.StreamHandler()
+    ch.setLevel(logging.WARNING)
+
+    # create formatter and add it to the handlers
+    formatter = logging.Formatter(FORMAT)
+    fh_debug.setFormatter(formatter)
+    fh_info.setFormatter(formatter)
+    ch.setFormatter(formatter)
+    handlers = [fh_debug, fh_info, ch]
+
+    if json_lines:
+        fh_json = logging.handlers.RotatingFileHandler(
+            f"{path}/log.jsonl", maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS
+        )
+        fh_json.setFormatter(JSONLinesFormatter())
+        handlers.append(fh_json)
+
+    # the handlers only run on the listener's thread, so writing logs never blocks the caller
+    records = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(
+        records, *handlers, respect_handler_level=True
+    )
+    logger.addHandler(LazyQueueHandler(records))
+    listener.start()
+    return listener
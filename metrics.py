@@ -0,0 +1,173 @@
+import bisect
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# upper bounds of histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+registry = dict()  # metric name -> metric, in the order they were created
+
+
+def escape(value):
+    # escape a label value as the Prometheus text format requires
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(names, values, extra=""):
+    # {name="value",...}, with extra (already formatted) added at the end
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """A metric with a value for each combination of label values. Recording a value only takes
+    a lock and updates a dict, so it is cheap enough for every tick."""
+
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = dict()  # label values -> value
+        self.lock = threading.Lock()
+        registry[name] = self
+
+    def key(self, labels):
+        return tuple(labels[name] for name in self.labels)
+
+    def samples(self):
+        # (suffix, label values, extra label, value) for each line of the metric
+        with self.lock:
+            return [("", key, "", value) for key, value in self.values.items()]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for suffix, key, extra, value in self.samples():
+            lines.append(
+                f"{self.name}{suffix}{format_labels(self.labels, key, extra)} {format_value(value)}"
+            )
+        return lines
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """A value that can go up and down. If collect is given, it is called when the metrics are
+    rendered and returns the values by label values, so nothing is recorded on the hot path.
+    """
+
+    type = "gauge"
+
+    def __init__(self, name, help, labels=(), collect=None):
+        super().__init__(name, help, labels)
+        self.collect = collect
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def samples(self):
+        if self.collect is not None:
+            return [("", key, "", value) for key, value in self.collect().items()]
+        return super().samples()
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            if key not in self.values:
+                # count of each bucket (and +Inf), sum, count
+                self.values[key] = [[0] * (len(self.buckets) + 1), 0, 0]
+            counts = self.values[key]
+            counts[0][bisect.bisect_left(self.buckets, value)] += 1
+            counts[1] += value
+            counts[2] += 1
+
+    def time(self, **labels):
+        """Context manager that observes how many seconds its body took."""
+        return Timer(self, labels)
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for key, (counts, total, count) in self.values.items():
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += bucket_count
+                    samples.append(
+                        ("_bucket", key, f'le="{format_value(bound)}"', cumulative)
+                    )
+                samples.append(("_sum", key, "", total))
+                samples.append(("_count", key, "", count))
+        return samples
+
+
+class Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+
+
+def render():
+    """All metrics in the Prometheus text format."""
+    lines = []
+    for metric in list(registry.values()):
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # do not log every scrape
+        pass
+
+
+def serve(port, host="127.0.0.1"):
+    """Serve the metrics on http://host:port/metrics from a background thread."""
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,169 @@
+import logging
+import random
+import threading
+import time
+from collections import deque
+
+from googleapiclient.errors import HttpError
+
+import metrics
+
+# Sheets API quotas are per minute, separately for reads and writes
+READ_QUOTA = 60  # read requests per minute
+WRITE_QUOTA = 60  # write requests per minute
+BURST = 10  # requests that can be sent at once before the rate limit applies
+
+MAX_ATTEMPTS = 5
+BASE_DELAY = 1  # seconds, doubled on each retry
+MAX_DELAY = 32  # seconds
+# seconds a request may spend retrying (and waiting for quota to retry) before its error is
+# raised, so errors do not hold up the scheduler thread - the job is retried with its own backoff
+MAX_RETRY_SECONDS = 5
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+api_seconds = metrics.Histogram(
+    "sheets_api_seconds", "Latency of Sheets API requests", ["method"]
+)
+api_errors = metrics.Counter(
+    "sheets_api_errors_total", "Sheets API requests that failed", ["method", "status"]
+)
+throttled_seconds = metrics.Counter(
+    "sheets_api_throttled_seconds_total",
+    "Time spent waiting to stay within quota",
+    ["kind"],
+)
+
+
+class TokenBucket:
+    """Allows rate requests per second on average, and up to capacity at once."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, timeout=None):
+        """Take a token, waiting for one if there are none. Returns the seconds waited, or None
+        (without waiting) if there would not be a token within timeout seconds."""
+        waited = 0
+        with self.lock:
+            self.refill()
+            if self.tokens < 1:
+                waited = (1 - self.tokens) / self.rate
+                if timeout is not None and waited > timeout:
+                    return None
+                time.sleep(waited)
+                self.refill()
+            self.tokens -= 1
+        return waited
+
+    def drain(self):
+        """Empty the bucket, e.g. after the quota was exceeded anyway."""
+        with self.lock:
+            self.refill()
+            self.tokens = min(self.tokens, 0)
+
+
+class Usage:
+    """Quota usage of one kind of request."""
+
+    def __init__(self):
+        self.requests = 0
+        self.retries = 0
+        self.failures = 0
+        self.throttled = 0  # seconds spent waiting for the rate limit
+        self.recent = deque()  # time.monotonic() of requests in the last minute
+
+    def record(self, waited):
+        now = time.monotonic()
+        self.requests += 1
+        self.throttled += waited
+        self.recent.append(now)
+        while self.recent and now - self.recent[0] > 60:
+            self.recent.popleft()
+
+    def to_dict(self):
+        return {
+            "requests": self.requests,
+            "last_minute": len(self.recent),
+            "retries": self.retries,
+            "failures": self.failures,
+            "throttled": self.throttled,
+        }
+
+
+buckets = {
+    "read": TokenBucket(READ_QUOTA / 60, BURST),
+    "write": TokenBucket(WRITE_QUOTA / 60, BURST),
+}
+usage = {kind: Usage() for kind in buckets}
+
+
+def retry_delay(error, attempt):
+    # use the server's Retry-After if it sent one, else exponential backoff with full jitter
+    retry_after = error.resp.get("retry-after")
+    if retry_after is not None and retry_after.isdigit():
+        return min(int(retry_after), MAX_DELAY)
+    return random.uniform(0, min(BASE_DELAY * 2**attempt, MAX_DELAY))
+
+
+def acquire(kind="read", timeout=None):
+    """Wait until a request of the given kind ("read" or "write") is within quota, and record it.
+    For requests that are not sent through execute(), e.g. by the sheet module.
+    Returns False, without waiting, if that would take longer than timeout seconds."""
+    waited = buckets[kind].acquire(timeout)
+    if waited is None:
+        return False
+    usage[kind].record(waited)
+    throttled_seconds.inc(waited, kind=kind)
+    return True
+
+
+def execute(request, kind="read"):
+    """Execute a Sheets API request within quota. Requests that fail with a rate limit or server
+    error are retried with backoff for up to MAX_RETRY_SECONDS, other errors (and the last
+    retry's) are raised."""
+    # e.g. sheets.spreadsheets.values.batchGet
+    method = getattr(request, "methodId", kind)
+    deadline = time.monotonic() + MAX_RETRY_SECONDS
+    error = None
+    for attempt in range(MAX_ATTEMPTS):
+        # the first attempt always waits for quota, retries only if it is available in time
+        timeout = None if error is None else max(deadline - time.monotonic(), 0)
+        if not acquire(kind, timeout):
+            usage[kind].failures += 1
+            raise error
+        try:
+            with api_seconds.time(method=method):
+                return request.execute()
+        except HttpError as e:
+            api_errors.inc(method=method, status=e.resp.status)
+            if e.resp.status == 429:
+                # the quota is shared with other clients, so slow down for everyone here
+                buckets[kind].drain()
+            delay = retry_delay(e, attempt)
+            if (
+                e.resp.status not in RETRYABLE_STATUSES
+                or attempt == MAX_ATTEMPTS - 1
+                or time.monotonic() + delay > deadline
+            ):
+                usage[kind].failures += 1
+                raise
+            logging.warning(
+                f"Sheets API {kind} failed with {e.resp.status}, retrying in {delay:.1f}s"
+            )
+            usage[kind].retries += 1
+            error = e
+            time.sleep(delay)
+
+
+def get_usage():
+    """Quota usage so far, per kind of request."""
+    return {kind: u.to_dict() for kind, u in usage.items()}
@@ -0,0 +1,114 @@
+import logging
+import random
+import time
+
+import metrics
+
+MAX_BACKOFF = 300  # seconds, longest a failing job waits before it is retried
+
+job_seconds = metrics.Histogram(
+    "scheduler_job_seconds", "Time taken by each run of a job", ["job"]
+)
+job_lag_seconds = metrics.Histogram(
+    "scheduler_job_lag_seconds", "How late each run of a job started", ["job"]
+)
+job_failures = metrics.Counter(
+    "scheduler_job_failures_total", "Runs of each job that failed", ["job"]
+)
+
+
+class Job:
+    """A function that a Scheduler runs every interval seconds."""
+
+    def __init__(self, name, func, interval, next_run, max_backoff=MAX_BACKOFF):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.max_backoff = max_backoff
+
+        self.next_run = next_run  # when the job is next due
+        self.runs = 0
+        self.failures = 0  # consecutive failures, reset when the job succeeds
+        self.last_duration = None  # seconds the last run took
+        self.last_lag = None  # seconds the last run started after it was due
+
+
+class Scheduler:
+    """Runs periodic jobs, each at its own interval.
+
+    A job fails if it raises an exception or returns False. A failing job is retried after
+    an exponential, jittered backoff, without holding up any other job. Between jobs the
+    scheduler calls wait with the seconds until the next job is due, so the caller can do
+    other work (like handling events) in the meantime. clock returns the current time in
+    seconds, and can be replaced to run jobs on a simulated clock.
+    """
+
+    def __init__(self, wait=time.sleep, clock=time.monotonic):
+        self.jobs = []
+        self.wait = wait
+        self.clock = clock
+
+    def add_job(self, name, func, interval, max_backoff=MAX_BACKOFF):
+        """Add a job, which is first run right away."""
+        job = Job(name, func, interval, self.clock(), max_backoff)
+        self.jobs.append(job)
+        return job
+
+    def run_job(self, job):
+        job.last_lag = self.clock() - job.next_run
+        started = time.perf_counter()
+        try:
+            success = job.func() is not False
+        except Exception:
+            logging.exception(f"Job {job.name} failed")
+            success = False
+        job.last_duration = time.perf_counter() - started
+        job.runs += 1
+        job_seconds.observe(job.last_duration, job=job.name)
+        job_lag_seconds.observe(job.last_lag, job=job.name)
+
+        if success:
+            job.failures = 0
+            job.next_run += job.interval
+            if job.next_run <= self.clock():
+                # skip runs that were missed rather than running them back to back
+                job.next_run = self.clock() + job.interval
+        else:
+            job.failures += 1
+            job_failures.inc(job=job.name)
+            backoff = min(job.interval * 2**job.failures, job.max_backoff)
+            # jitter, so jobs failing on the same API do not all retry at once
+            backoff *= random.uniform(0.5, 1.5)
+            logging.warning(
+                f"Job {job.name} failed {job.failures} times in a row, retrying in {backoff:.1f}s"
+            )
+            job.next_run = self.clock() + backoff
+
+    def run_pending(self):
+        """Run every job that is due."""
+        for job in self.jobs:
+            if self.clock() >= job.next_run:
+                self.run_job(job)
+
+    def time_until_next(self):
+        return max(min(job.next_run for job in self.jobs) - self.clock(), 0)
+
+    def run(self):
+        """Run jobs as they are due, forever."""
+        while True:
+            self.run_pending()
+            self.wait(self.time_until_next())
+
+    def stats(self):
+        """Per job: interval, runs, consecutive failures, and the duration and lag of the last run
+        (seconds)."""
+        return {
+            job.name: {
+                "interval": job.interval,
+                "runs": job.runs,
+                "failures": job.failures,
+                "last_duration": job.last_duration,
+                "last_lag": job.last_lag,
+            }
+            for job in self.jobs
+        }
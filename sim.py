@@ -0,0 +1,331 @@
+"""Offline stand-ins for the Google APIs and printers, for running the scheduler in callback.py
+without the network, real printers or printers.json, on a simulated clock.
+
+    sim = Simulation(printers=10, bookings=1000)
+    for _ in range(600):
+        sim.tick()
+"""
+
+import datetime
+import logging
+import random
+import re
+import sys
+import tempfile
+import types
+from collections import Counter
+
+from state_store import StateStore
+
+START = datetime.datetime(2024, 1, 8, 12)  # a Monday at noon, when the lab opens
+STARTING_TIME_FORMAT = "%m/%d/%Y %H:%M:%S"
+STAFF = ["staff0", "staff1", "staff2"]
+
+
+class VirtualClock:
+    """A clock that only moves when advanced."""
+
+    def __init__(self, start=START):
+        self.start = start
+        self.seconds = 0.0
+
+    def now(self):
+        return self.start + datetime.timedelta(seconds=self.seconds)
+
+    def monotonic(self):
+        return self.seconds
+
+    def advance(self, seconds):
+        self.seconds += seconds
+
+
+class FakeRequest:
+    def __init__(self, func):
+        self.func = func
+
+    def execute(self):
+        return self.func()
+
+
+class FakeSheets:
+    """In-memory stand-in for the spreadsheets() resource of the Sheets API. Sheets are lists of
+    rows of strings, and every request made is counted by method in calls."""
+
+    def __init__(self, sheets):
+        self.sheets = sheets  # sheet name -> rows
+        self.calls = Counter()
+
+    def values(self):
+        return self
+
+    def select(self, a1):
+        # rows of an A1 range: a whole sheet, 'Sheet'!1:1, 'Sheet'!A5:C or Sheet!A2:B
+        name, _, cells = a1.partition("!")
+        rows = self.sheets.setdefault(name.strip("'"), [])
+        if not cells:
+            return rows, 0, len(rows)
+        match = re.fullmatch(r"[A-Z]*(\d+)(?::[A-Z]*(\d*))?", cells)
+        first = int(match.group(1)) - 1
+        last = int(match.group(2)) if match.group(2) else len(rows)
+        return rows, first, last
+
+    def batchGet(self, spreadsheetId, ranges):
+        self.calls["batchGet"] += 1
+
+        def execute():
+            value_ranges = []
+            for a1 in ranges:
+                rows, first, last = self.select(a1)
+                value_ranges.append(
+                    {"range": a1, "values": [list(row) for row in rows[first:last]]}
+                )
+            return {"valueRanges": value_ranges}
+
+        return FakeRequest(execute)
+
+    def batchUpdate(self, spreadsheetId, body):
+        self.calls["batchUpdate"] += 1
+
+        def execute():
+            for value_range in body["data"]:
+                rows, first, _ = self.select(value_range["range"])
+                for i, values in enumerate(value_range["values"], first):
+                    rows.extend([] for _ in range(i + 1 - len(rows)))
+                    rows[i] = [str(v) for v in values]
+            return {"totalUpdatedRows": sum(len(v["values"]) for v in body["data"])}
+
+        return FakeRequest(execute)
+
+    def clear(self, spreadsheetId, range):
+        self.calls["clear"] += 1
+
+        def execute():
+            rows, first, last = self.select(range)
+            for i in range(first, min(last, len(rows))):
+                rows[i] = []
+            return {}
+
+        return FakeRequest(execute)
+
+    def append_row(self, name, row):
+        # a form submission, which the forms add to the end of their sheet
+        self.sheets[name].append([str(v) for v in row])
+
+
+class FakeGmail:
+    """Stand-in for gmail.gmail_queue_message that records the messages instead of sending them."""
+
+    def __init__(self):
+        self.messages = []
+
+    def queue_message(self, recipient, sender, subject, body, cc, reply_to):
+        self.messages.append((recipient, subject))
+        return str(len(self.messages))
+
+
+def fake_access_sheet(staff, certified):
+    """Stand-in for the sheet module that reads the Access Card sheet. It has to be in
+    sys.modules before access (and so callback) is imported."""
+    module = types.ModuleType("sheet")
+    module.SPREADSHEET_ID = None  # no Drive revision checks
+    module.get_sheet_data = lambda write=True: None
+    module.is_staff = lambda cruzid=None: cruzid in staff
+    module.get_access = lambda tool, cruzid=None: cruzid in certified
+    return module
+
+
+class FakePrinter:
+    """Stand-in for bpm's BambuPrinter, driven by a scripted timeline of prints.
+
+    The timeline is a list of (start, end) seconds on the simulated clock. advance() moves the
+    printer along its timeline and calls on_update, like bpm does for every MQTT message.
+    """
+
+    def __init__(self, config=None, timeline=()):
+        from bpm.bambutools import PrinterState
+
+        self.config = config
+        self.timeline = list(timeline)
+        self.state = PrinterState.NO_STATE
+        self.on_update = None
+
+        self._lastMessageTime = None
+        self.gcode_state = "IDLE"
+        self.gcode_file = ""
+        self.tool_temp = self.bed_temp = 20.0
+        self.tool_temp_target = self.bed_temp_target = 0
+        self.fan_speed = 0
+        self.speed_level = 2
+        self.light_state = True
+        self.current_stage = 0
+        self.current_layer = self.layer_count = 0
+        self.percent_complete = 0
+        self.time_remaining = 0
+        self.active_spool = 0
+        self.spool_state = ""
+        self.start_time = 0
+
+    def start_session(self):
+        from bpm.bambutools import PrinterState
+
+        self.state = PrinterState.CONNECTED
+
+    def quit(self):
+        from bpm.bambutools import PrinterState
+
+        self.state = PrinterState.QUIT
+
+    def advance(self, clock):
+        """Move to the state of the timeline at the clock's time. Returns True if a print just
+        started."""
+        seconds = clock.monotonic()
+        started = False
+        while self.timeline and self.timeline[0][1] <= seconds:
+            self.timeline.pop(0)
+            self.gcode_state = "FINISH"
+            self.tool_temp_target = self.bed_temp_target = 0
+            self.percent_complete = 100
+            self.time_remaining = 0
+
+        if self.timeline and self.timeline[0][0] <= seconds:
+            start, end = self.timeline[0]
+            if self.gcode_state != "RUNNING":
+                started = True
+                self.gcode_state = "RUNNING"
+                self.gcode_file = f"print-{start:.0f}.3mf"
+                self.start_time = int(
+                    (clock.now().timestamp() - (seconds - start)) // 60
+                )
+                self.tool_temp_target, self.bed_temp_target = 210, 60
+                self.layer_count = int(end - start) // 30
+            progress = (seconds - start) / (end - start)
+            self.percent_complete = int(progress * 100)
+            self.current_layer = int(progress * self.layer_count)
+            self.time_remaining = int((end - seconds) // 60)
+
+        self._lastMessageTime = clock.now().timestamp()
+        if self.on_update is not None:
+            self.on_update(self)
+        return started
+
+
+def print_timeline(rng, duration, idle=(300, 3600), printing=(600, 7200)):
+    # alternating idle gaps and prints, in seconds, over the given duration. The cycle starts up
+    # to one idle gap and print before the simulation, so some printers are mid-print from the start
+    timeline = []
+    t = rng.uniform(*idle) - rng.uniform(0, idle[1] + printing[1])
+    while t < duration:
+        length = rng.uniform(*printing)
+        if t + length > 0:
+            timeline.append((t, t + length))
+        t += length + rng.uniform(*idle)
+    return timeline
+
+
+def automation_sheets(printer_names, bookings, users, rng, clock):
+    # the printer automations sheets, with bookings submitted over the past week
+    booking_rows = [["Timestamp", "Email Address", "Status", "Estimated Start"]]
+    submitted = clock.now() - datetime.timedelta(days=7)
+    for i in range(bookings):
+        timestamp = submitted + datetime.timedelta(seconds=i * 7 * 86400 / bookings)
+        booking_rows.append(
+            [
+                timestamp.strftime(STARTING_TIME_FORMAT),
+                f"{rng.choice(users)}@ucsc.edu",
+                "",
+            ]
+        )
+
+    return {
+        "Booking": booking_rows,
+        "Starting": [["Timestamp", "Email Address", "Printer", "Weight", "Handled"]],
+        "Printer Status": [
+            ["Printer Name", "Status", "Current User", "Start Time", "End Time"]
+        ]
+        + [[name, "Available", "", "", ""] for name in printer_names],
+        "Filament Limits": [["CruzID", "Limit (grams)"]]
+        + [[user, str(rng.randint(0, 1000))] for user in users[: len(users) // 2]],
+        "Filament Limits Reset Date": [["12/31/2099"]],
+    }
+
+
+class Simulation:
+    """callback.py running against the fakes, on a virtual clock.
+
+    callback keeps its state in module globals, so there can only be one Simulation per process.
+    """
+
+    def __init__(self, printers=10, bookings=1000, users=None, duration=86400, seed=0):
+        self.rng = random.Random(seed)
+        self.clock = VirtualClock()
+        self.gmail = FakeGmail()
+
+        users = [f"user{i}" for i in range(users or max(bookings // 5, 1))]
+        certified = set(u for u in users if self.rng.random() < 0.9) | set(STAFF)
+        sys.modules["sheet"] = fake_access_sheet(set(STAFF), certified)
+
+        import callback
+        import quota
+
+        names = [f"Printer {i}" for i in range(printers)]
+        self.sheets = FakeSheets(
+            automation_sheets(names, bookings, users, self.rng, self.clock)
+        )
+        timelines = {name: print_timeline(self.rng, duration) for name in names}
+
+        # keep records for the level set on the logger, but do not write them anywhere
+        logging.getLogger("root").addHandler(logging.NullHandler())
+        # the fakes have no quota, so do not hold up requests to stay within it
+        for kind in quota.buckets:
+            quota.buckets[kind] = quota.TokenBucket(1e9, 1e9)
+
+        callback.now = self.clock.now
+        callback.g_sheets = self.sheets
+        callback.gmail_queue_message = self.gmail.queue_message
+        callback.state_store = StateStore(":memory:")
+        callback.TELEMETRY_PATH = tempfile.mkdtemp(prefix="telemetry-")
+        callback.printer_data = {
+            name: {
+                "hostname": f"10.0.0.{i}",
+                "access_code": "",
+                "serial_number": name,
+            }
+            for i, name in enumerate(names)
+        }
+        callback.BambuPrinter = lambda config: FakePrinter(
+            config, timelines[config.serial_number]
+        )
+
+        self.callback = callback
+        callback.start()
+        self.scheduler = callback.create_scheduler(
+            wait=self.clock.advance, clock=self.clock.monotonic
+        )
+
+    def submit_start_form(self, name):
+        # the user booked on the printer submits the start form, or staff if nobody is booked
+        row = next(r for r in self.sheets.sheets["Printer Status"] if r[0] == name)
+        user = row[2] if len(row) > 2 and row[1] == "Booked" else self.rng.choice(STAFF)
+        self.sheets.append_row(
+            "Starting",
+            [
+                self.clock.now().strftime(STARTING_TIME_FORMAT),
+                f"{user}@ucsc.edu",
+                name,
+                self.rng.randint(5, 200),
+                "",
+            ],
+        )
+
+    def tick(self, seconds=1):
+        """Advance the clock, push updates from every printer, and run the scheduler's events and
+        due jobs. Returns the number of Sheets API requests made."""
+        self.clock.advance(seconds)
+        for name, printer in self.callback.printers:
+            if printer.advance(self.clock):
+                self.submit_start_form(name)
+
+        calls = sum(self.sheets.calls.values())
+        self.callback.handle_printer_events(0)
+        self.scheduler.run_pending()
+        return sum(self.sheets.calls.values()) - calls
@@ -0,0 +1,47 @@
+import json
+import sqlite3
+
+
+class StateStore:
+    """Scheduler state checkpointed to an SQLite database in WAL mode, as JSON values by key.
+
+    Only keys whose value changed since the last checkpoint are written, so checkpointing
+    every tick costs next to nothing when little has changed.
+    """
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        # WAL with synchronous=NORMAL is durable across crashes of this process
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT NOT NULL)"
+        )
+        self.connection.commit()
+        self.saved = dict()  # key -> JSON as last written, to skip unchanged keys
+
+    def save(self, state):
+        """Write the values in state (a dict of JSON-serializable values) in one transaction."""
+        changed = []
+        for key, value in state.items():
+            # numpy scalars (e.g. pandas index labels) are converted to Python numbers
+            encoded = json.dumps(value, default=lambda o: o.item())
+            if self.saved.get(key) != encoded:
+                changed.append((key, encoded))
+
+        if not changed:
+            return
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)", changed
+            )
+        self.saved.update(changed)
+
+    def load(self):
+        """Read every saved value. Returns: dict of key -> value, empty if nothing was saved"""
+        rows = self.connection.execute("SELECT key, value FROM state").fetchall()
+        self.saved = dict(rows)
+        return {key: json.loads(value) for key, value in rows}
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,173 @@
+import json
+import os
+import threading
+
+import numpy as np
+
+# printer attributes recorded, in the order of the values of each sample
+FIELDS = (
+    "tool_temp",
+    "bed_temp",
+    "fan_speed",
+    "current_layer",
+    "percent_complete",
+    "time_remaining",
+)
+
+SAMPLE_INTERVAL = 1  # seconds, at most one sample per printer is recorded per interval
+RECENT_CAPACITY = 900  # samples kept at full rate - 15 minutes at 1 Hz
+HISTORY_INTERVAL = 60  # seconds averaged into each sample of the history
+HISTORY_CAPACITY = 1440  # 24 hours of 1 minute means
+
+SAMPLE = np.dtype([("time", "f8"), ("values", "f4", (len(FIELDS),))])
+
+
+class RingBuffer:
+    """A fixed number of samples, where each new sample overwrites the oldest one.
+
+    array is a structured array of SAMPLE with one row per sample. Empty rows have time 0,
+    so a buffer can be rebuilt from an array that was saved (or memory-mapped) before.
+    """
+
+    def __init__(self, array):
+        self.array = array
+        self.capacity = len(array)
+        self.count = int(np.count_nonzero(array["time"]))
+        # the next row to write is the one after the newest sample
+        self.head = (
+            (int(np.argmax(array["time"])) + 1) % self.capacity if self.count else 0
+        )
+
+    def __len__(self):
+        return self.count
+
+    def append(self, time, values):
+        self.array[self.head] = (time, values)
+        self.head = (self.head + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def last(self, n=None):
+        """The newest n samples (or all of them), oldest first."""
+        n = self.count if n is None else min(n, self.count)
+        start = self.head - n
+        if start >= 0:
+            return self.array[start : self.head].copy()
+        return np.concatenate((self.array[start:], self.array[: self.head]))
+
+    def since(self, time):
+        """The samples from the given time onward, oldest first."""
+        samples = self.last()
+        return samples[np.searchsorted(samples["time"], time) :]
+
+
+class PrinterTelemetry:
+    """Telemetry of one printer: every sample from the last RECENT_CAPACITY seconds, and
+    the mean of every HISTORY_INTERVAL from the last HISTORY_CAPACITY intervals."""
+
+    def __init__(self, recent, history):
+        self.recent = recent
+        self.history = history
+        self.lock = threading.Lock()  # recorded from the printer's MQTT thread
+        self.last_time = recent.last(1)["time"][0] if len(recent) else None
+
+        # sums of the samples of the current history interval, which starts at interval_start
+        self.interval_start = None
+        self.interval_sum = np.zeros(len(FIELDS))
+        self.interval_count = 0
+
+    def record(self, time, values):
+        with self.lock:
+            if self.last_time is not None and time - self.last_time < SAMPLE_INTERVAL:
+                return
+            self.recent.append(time, values)
+            self.last_time = time
+
+            if self.interval_start is None:
+                self.interval_start = time - time % HISTORY_INTERVAL
+            elif time >= self.interval_start + HISTORY_INTERVAL:
+                # the interval is over, so record its mean in the history
+                self.history.append(
+                    self.interval_start, self.interval_sum / self.interval_count
+                )
+                self.interval_start = time - time % HISTORY_INTERVAL
+                self.interval_sum[:] = 0
+                self.interval_count = 0
+            self.interval_sum += values
+            self.interval_count += 1
+
+    def window(self, seconds, now):
+        """Samples from the last seconds before now - at full rate if the recent samples go back
+        that far, otherwise from the history."""
+        start = now - seconds
+        with self.lock:
+            recent = self.recent.last()
+            if len(recent) and (recent["time"][0] <= start or len(self.history) == 0):
+                return recent[np.searchsorted(recent["time"], start) :]
+            return self.history.since(start)
+
+    def stats(self, field, seconds, now):
+        """min, max and mean of a field over the last seconds before now, or None if there are
+        no samples in that time."""
+        values = self.window(seconds, now)["values"][:, FIELDS.index(field)]
+        if not len(values):
+            return None
+        return {
+            "min": float(values.min()),
+            "max": float(values.max()),
+            "mean": float(values.mean()),
+        }
+
+    def last(self, field, n):
+        """The newest n values of a field, oldest first."""
+        with self.lock:
+            return self.recent.last(n)["values"][:, FIELDS.index(field)]
+
+
+def open_samples(path, printers, capacity):
+    # memory-map an array of samples for each printer, keeping what was saved if it fits
+    if os.path.exists(path):
+        array = np.lib.format.open_memmap(path, mode="r+")
+        if array.dtype == SAMPLE and array.shape == (printers, capacity):
+            return array
+        del array
+    return np.lib.format.open_memmap(
+        path, mode="w+", dtype=SAMPLE, shape=(printers, capacity)
+    )
+
+
+class Telemetry:
+    """Telemetry of every printer, kept in memory-mapped files in a directory so snapshots are
+    just a flush, and the history survives a restart."""
+
+    def __init__(self, names, path):
+        os.makedirs(path, exist_ok=True)
+        names_path = f"{path}/printers.json"
+        if os.path.exists(names_path) and json.load(open(names_path)) != names:
+            # the saved rows belong to other printers
+            for name in ("recent.npy", "history.npy"):
+                if os.path.exists(f"{path}/{name}"):
+                    os.remove(f"{path}/{name}")
+        with open(names_path, "w") as f:
+            json.dump(names, f)
+
+        self.recent = open_samples(f"{path}/recent.npy", len(names), RECENT_CAPACITY)
+        self.history = open_samples(f"{path}/history.npy", len(names), HISTORY_CAPACITY)
+        self.printers = {
+            name: PrinterTelemetry(
+                RingBuffer(self.recent[i]), RingBuffer(self.history[i])
+            )
+            for i, name in enumerate(names)
+        }
+
+    def __getitem__(self, name):
+        return self.printers[name]
+
+    def record(self, name, printer, time):
+        """Record the telemetry of a bpm printer at the given time (in seconds)."""
+        values = [float(getattr(printer, field) or 0) for field in FIELDS]
+        self.printers[name].record(time, values)
+
+    def snapshot(self):
+        """Write the samples recorded since the last snapshot to disk."""
+        self.recent.flush()
+        self.history.flush()